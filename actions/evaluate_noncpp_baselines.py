@@ -8,7 +8,7 @@ from learning.gp.explore_single_bb import create_single_bb_gpucb_dataset
 from gen.generate_policy_data import get_bb_dataset
 from gen.generator_busybox import BusyBox
 from actions import policies
-from utils.setup_pybullet import setup_env
+from utils.setup_pybullet import setup_env, disconnect
 from utils import util
 
 def main(args):
@@ -26,7 +26,7 @@ def main(args):
             print('steps', steps)
         elif args.type == 'random':
             bb = BusyBox.bb_from_result(bb_results[0])
-            image_data, gripper = setup_env(bb, args.viz, args.debug)
+            _, gripper = setup_env(bb, args.viz, args.debug, render=False)
             regret = float("inf")
             steps = 0
             while regret > SUCCESS_REGRET:
@@ -50,7 +50,7 @@ def main(args):
                 
                 # reset
                 gripper.reset(mech)
-            p.disconnect()
+            disconnect(gripper.client)
             all_steps.append(steps)
             print('steps', steps)
 
@@ -84,7 +84,7 @@ if __name__ == '__main__':
     parser.add_argument(
         '--urdf-num',
         default=0,
-        help='number to append to generated urdf files. Use if generating multiple datasets simultaneously.')
+        help='unused, urdf files are now cached by busybox contents (kept for old scripts)')
     parser.add_argument(
         '--bb-fname',
         default='',
@@ -93,6 +93,15 @@ if __name__ == '__main__':
         '--plot',
         action='store_true',
         help='use to generate polar plots durin GP-UCB interactions')
+    parser.add_argument(
+        '--batch-optim',
+        action='store_true',
+        help='optimize the GP-UCB starts together instead of one at a time')
+    parser.add_argument(
+        '--gp-refit-every',
+        type=int,
+        default=10,
+        help='number of interactions between optimizing the GP kernel noise (0 to never optimize it)')
     parser.add_argument(
         '--debug',
         action='store_true',
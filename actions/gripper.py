@@ -39,7 +39,7 @@ _thresh - threshold
 _M - matrix form of a pose/transformation
 """
 class Gripper:
-    def __init__(self, mech, k=[2000.0,20.0], d=[0.45,0.45]):
+    def __init__(self, mech, k=[2000.0,20.0], d=[0.45,0.45], client=0, lean_pd=True):
         """
         This class defines the actions a gripper can take such as grasping a handle
         and executing PD control
@@ -48,10 +48,15 @@ class Gripper:
                     (stiffness) gain and the second entry is the angular position gain
         :param d: a vector of length 2 where the first entry is the linear derivative
                     (damping) gain and the second entry is the angular derivative gain
+        :param client: the pyBullet physics client the gripper (and mech) live in
+        :param lean_pd: if True (and not using the gripper body) use _move_PD_lean
+                    instead of _move_PD to execute trajectories
         """
+        self.client = client
+        self.lean_pd = lean_pd
         self.use_gripper = False
         if self.use_gripper:
-            self.id = p.loadSDF("models/gripper/gripper_high_fric.sdf")[0]
+            self.id = p.loadSDF("models/gripper/gripper_high_fric.sdf", physicsClientId=self.client)[0]
             self._left_finger_tip_id = 2
             self._right_finger_tip_id = 5
             self._left_finger_base_joint_id = 0
@@ -61,38 +66,41 @@ class Gripper:
                                 [0.50019904,  0.50019904, -0.49980088, 0.49980088])
             # get mass of gripper
             mass = 0
-            for link in range(p.getNumJoints(self.id)):
-                mass += p.getDynamicsInfo(self.id, link)[0]
+            for link in range(p.getNumJoints(self.id, physicsClientId=self.client)):
+                mass += p.getDynamicsInfo(self.id, link, physicsClientId=self.client)[0]
             self._mass = mass
 
         self.errors = []
         self.forces = []
 
+        # pyBullet state id of the snapshot restored on reset, see save_state()
+        self._state_id = None
+
         # control parameters
         self.k = k
         self.d = d
 
     def _get_p_tip_world(self):
-        p_left_world = p.getLinkState(self.id, self._left_finger_tip_id)[0]
-        p_right_world = p.getLinkState(self.id, self._right_finger_tip_id)[0]
+        p_left_world = p.getLinkState(self.id, self._left_finger_tip_id, physicsClientId=self.client)[0]
+        p_right_world = p.getLinkState(self.id, self._right_finger_tip_id, physicsClientId=self.client)[0]
         p_tip_world = np.mean([p_left_world, p_right_world], axis=0)
         return p_tip_world
 
     def _get_p_tip_base(self):
-        p_base_world, q_base_world = p.getBasePositionAndOrientation(self.id)
+        p_base_world, q_base_world = p.getBasePositionAndOrientation(self.id, physicsClientId=self.client)
         p_tip_world = self._get_p_tip_world()
         p_tip_base = util.transformation(p_tip_world, p_base_world, q_base_world, inverse=True)
         return p_tip_base
 
     def _get_pose_com_(self, frame):
         com_numerator = np.array([0.0, 0.0, 0.0])
-        for link_index in range(p.getNumJoints(self.id)):
-            link_com = p.getLinkState(self.id, link_index)[0]
-            link_mass = p.getDynamicsInfo(self.id, link_index)[0]
+        for link_index in range(p.getNumJoints(self.id, physicsClientId=self.client)):
+            link_com = p.getLinkState(self.id, link_index, physicsClientId=self.client)[0]
+            link_mass = p.getDynamicsInfo(self.id, link_index, physicsClientId=self.client)[0]
             com_numerator = np.add(com_numerator, np.multiply(link_mass,link_com))
         p_com_world = np.divide(com_numerator, self._mass)
 
-        p_base_world, q_base_world = p.getBasePositionAndOrientation(self.id)
+        p_base_world, q_base_world = p.getBasePositionAndOrientation(self.id, physicsClientId=self.client)
         q_com_world = q_base_world
 
         if frame == 'world':
@@ -111,7 +119,7 @@ class Gripper:
         p_com_tip, q_com_tip = self._get_pose_com_('tip')
         v_com_world_des = util.adjoint_transformation(v_tip_world_des, p_com_tip, q_com_tip, inverse=True)
 
-        v_base_world = np.concatenate(p.getBaseVelocity(self.id))
+        v_base_world = np.concatenate(p.getBaseVelocity(self.id, physicsClientId=self.client))
         p_com_base, q_com_base = self._get_pose_com_('base')
         v_com_world = util.adjoint_transformation(v_base_world, p_com_base, q_com_base, inverse=True)
 
@@ -148,8 +156,9 @@ class Gripper:
     def _set_pose_tip_world(self, pose_tip_world_des, reset=False):
         p_base_tip = np.multiply(-1, self._get_p_tip_base())
         p_base_world_des = util.transformation(p_base_tip, pose_tip_world_des.p, pose_tip_world_des.q)
-        p.resetBasePositionAndOrientation(self.id, p_base_world_des, pose_tip_world_des.q)
-        p.stepSimulation()
+        p.resetBasePositionAndOrientation(self.id, p_base_world_des, pose_tip_world_des.q,
+                                          physicsClientId=self.client)
+        p.stepSimulation(physicsClientId=self.client)
 
     def _grasp_handle(self, pose_tip_world_des, debug=False):
         # move to default start pose
@@ -173,11 +182,11 @@ class Gripper:
             finger_angle = 0.2
         elif finger_state == 'close':
             finger_angle = 0.0
-        p.setJointMotorControl2(self.id,self._left_finger_base_joint_id,p.POSITION_CONTROL,targetPosition=-finger_angle,force=self._finger_force)
-        p.setJointMotorControl2(self.id,self._right_finger_base_joint_id,p.POSITION_CONTROL,targetPosition=finger_angle,force=self._finger_force)
-        p.setJointMotorControl2(self.id,2,p.POSITION_CONTROL,targetPosition=0,force=self._finger_force)
-        p.setJointMotorControl2(self.id,5,p.POSITION_CONTROL,targetPosition=0,force=self._finger_force)
-        p.stepSimulation()
+        p.setJointMotorControl2(self.id,self._left_finger_base_joint_id,p.POSITION_CONTROL,targetPosition=-finger_angle,force=self._finger_force,physicsClientId=self.client)
+        p.setJointMotorControl2(self.id,self._right_finger_base_joint_id,p.POSITION_CONTROL,targetPosition=finger_angle,force=self._finger_force,physicsClientId=self.client)
+        p.setJointMotorControl2(self.id,2,p.POSITION_CONTROL,targetPosition=0,force=self._finger_force,physicsClientId=self.client)
+        p.setJointMotorControl2(self.id,5,p.POSITION_CONTROL,targetPosition=0,force=self._finger_force,physicsClientId=self.client)
+        p.stepSimulation(physicsClientId=self.client)
 
     def _move_PD(self, pose_handle_base_world_des, q_offset, mech, last_traj_p, debug=False, stable_timeout=100, unstable_timeout=1000):
         finished = False
@@ -201,7 +210,8 @@ class Gripper:
             if not self.use_gripper:
                 lin_v_com_world_err = p.getLinkState(mech._get_bb_id(), \
                                                         mech._get_handle_id(),
-                                                        computeLinkVelocity=1)[6]
+                                                        computeLinkVelocity=1,
+                                                        physicsClientId=self.client)[6]
             else:
                 v_tip_world_des = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
                 lin_v_com_world_err, omega_com_world_err = self._get_v_com_world_error(v_tip_world_des)
@@ -223,17 +233,73 @@ class Gripper:
                 handle_q = mech.get_pose_handle_base_world().q
                 # transform the force into the LINK_FRAME to apply
                 f = util.transformation(f, [0.,0.,0.], handle_q, inverse=True)
-                p.applyExternalForce(bb_id, handle_id, f, [0.,0.,0.], p.LINK_FRAME)
+                p.applyExternalForce(bb_id, handle_id, f, [0.,0.,0.], p.LINK_FRAME, physicsClientId=self.client)
                 if debug:
-                    p.addUserDebugLine(handle_pos, np.add(handle_pos, 2*(f/np.linalg.norm(f))), lifeTime=.05)
+                    p.addUserDebugLine(handle_pos, np.add(handle_pos, 2*(f/np.linalg.norm(f))), lifeTime=.05,
+                                       physicsClientId=self.client)
             else:
                 p_com_world, q_com_world = self._get_pose_com_('world')
-                p.applyExternalForce(self.id, -1, f, p_com_world, p.WORLD_FRAME)
+                p.applyExternalForce(self.id, -1, f, p_com_world, p.WORLD_FRAME, physicsClientId=self.client)
                 # there is a bug in pyBullet. the link frame and world frame are inverted
                 # this should be executed in the WORLD_FRAME
-                p.applyExternalTorque(self.id, -1, tau, p.LINK_FRAME)
+                p.applyExternalTorque(self.id, -1, tau, p.LINK_FRAME, physicsClientId=self.client)
+
+            p.stepSimulation(physicsClientId=self.client)
+
+    def _move_PD_lean(self, p_handle_base_world_des, mech, last_traj_p, debug=False, stable_timeout=100, unstable_timeout=1000):
+        """ Same controller as _move_PD without the gripper body, but the handle link
+        state is read once per step, stability is tracked with a ring buffer of the last
+        9 step displacements and a running sum of them, and errors and forces are only
+        logged (for plot_err_forces) if debug.
+        :param p_handle_base_world_des: np.array of length 3, the waypoint position
+        :return: the handle base position at the first and at the last step, and
+                    True if the trajectory should not be continued
+        """
+        bb_id = mech._get_bb_id()
+        handle_id = mech._get_handle_id()
+        p_handle_base_handle = np.array([0., 0., mech.handle_length/2])
+        thresh = 0.000001 if last_traj_p else 0.01
 
-            p.stepSimulation()
+        # norms of the last 9 displacements (what _stable sums over the last 10 positions)
+        moves = np.zeros(9)
+        movement = 0.0
+        p_handle_base_world_init = None
+        for i in itertools.count():
+            link_state = p.getLinkState(bb_id, handle_id, computeLinkVelocity=1,
+                                        physicsClientId=self.client)
+            R_handle_world = np.reshape(p.getMatrixFromQuaternion(link_state[1]), (3,3))
+            p_handle_base_world = R_handle_world.dot(p_handle_base_handle) + link_state[0]
+            if p_handle_base_world_init is None:
+                p_handle_base_world_init = p_handle_base_world
+            else:
+                move = np.linalg.norm(p_handle_base_world - p_handle_base_world_prev)
+                movement += move - moves[i % 9]
+                moves[i % 9] = move
+            p_handle_base_world_prev = p_handle_base_world
+            stable = (i >= 9) and (movement < 0.005)
+
+            p_handle_base_world_err = p_handle_base_world_des - p_handle_base_world
+            at_des = np.linalg.norm(p_handle_base_world_err) < thresh
+            if (not last_traj_p) and at_des:
+                return p_handle_base_world_init, p_handle_base_world, False
+            elif last_traj_p and at_des and stable:
+                return p_handle_base_world_init, p_handle_base_world, True
+            elif stable and (i > stable_timeout):
+                return p_handle_base_world_init, p_handle_base_world, True
+            elif i > unstable_timeout:
+                return p_handle_base_world_init, p_handle_base_world, True
+
+            f = self.k[0]*p_handle_base_world_err + np.multiply(self.d[0], link_state[6])
+            if debug:
+                self.errors += [(p_handle_base_world_err, link_state[6])]
+                self.forces += [(f, [0, 0, 0])]
+            # transform the force into the LINK_FRAME to apply
+            f = R_handle_world.T.dot(f)
+            p.applyExternalForce(bb_id, handle_id, f, [0.,0.,0.], p.LINK_FRAME, physicsClientId=self.client)
+            if debug:
+                p.addUserDebugLine(p_handle_base_world, np.add(p_handle_base_world, 2*(f/np.linalg.norm(f))), lifeTime=.05,
+                                   physicsClientId=self.client)
+            p.stepSimulation(physicsClientId=self.client)
 
     def set_control_params(self, policy_type):
         if policy_type == 'Revolute' and not self.use_gripper:
@@ -262,10 +328,16 @@ class Gripper:
             pose_tip_world_init = util.Pose(p_tip_world_init, self.pose_tip_world_reset.q)
             self._grasp_handle(pose_tip_world_init, debug)
         cumu_motion = 0.0
+        lean_pd = self.lean_pd and not self.use_gripper
         for i in range(len(traj)):
             last_traj_p = (i == len(traj)-1)
-            handle_base_ps, finished = self._move_PD(traj[i], q_offset, mech, last_traj_p, debug)
-            cumu_motion = np.add(cumu_motion, np.linalg.norm(np.subtract(handle_base_ps[-1],handle_base_ps[0])))
+            if lean_pd:
+                p_handle_base_world_des = np.asarray(traj[i].p, dtype=float)
+                p_start, p_end, finished = self._move_PD_lean(p_handle_base_world_des, mech, last_traj_p, debug)
+            else:
+                handle_base_ps, finished = self._move_PD(traj[i], q_offset, mech, last_traj_p, debug)
+                p_start, p_end = handle_base_ps[0], handle_base_ps[-1]
+            cumu_motion = np.add(cumu_motion, np.linalg.norm(np.subtract(p_end, p_start)))
             if finished:
                 break
         pose_handle_world_final = None
@@ -280,6 +352,10 @@ class Gripper:
         return cumu_motion, net_motion, pose_handle_world_final
 
     def plot_err_forces(self):
+        if len(self.errors) == 0:
+            print('no errors or forces to plot, trajectories executed with lean_pd are '+\
+                    'only logged if debug')
+            return
         import matplotlib.pyplot as plt
         plt.ion()
         fig, axes = plt.subplots(3,1)
@@ -297,7 +373,17 @@ class Gripper:
         plt.show()
         input()
 
+    def save_state(self):
+        """ Snapshot the simulation. Every following reset() restores this exact
+        state (positions, velocities and contact information) so repeated trials
+        start from an identical state.
+        """
+        self._state_id = p.saveState(physicsClientId=self.client)
+
     def reset(self, mech):
+        if self._state_id is not None:
+            p.restoreState(stateId=self._state_id, physicsClientId=self.client)
+            return
         mech.reset()
         if self.use_gripper:
             self._set_pose_tip_world(self.pose_tip_world_reset)
@@ -1,7 +1,6 @@
 from collections import namedtuple, OrderedDict
 import numpy as np
 from utils import util
-import itertools
 import pybullet as p
 
 """See actions.gripper for variable naming and naming conventions
@@ -42,29 +41,38 @@ class Policy(object):
         :param debug: if True, display debug visualizations
         :param p_delta: scalar, the distance between trajectory waypoints
         """
-        # TODO: don't assume handle always starts at config = 0
-        config_curr = self._inverse_kinematics(*pose_handle_base_world)
-        config_dir_unit = self._config_dir(config_curr)
-        config_delta = p_delta*config_dir_unit
-
-        poses = []
-        for i in itertools.count():
-            if i < 400:
-                if self._past_goal_config(config_curr, config_dir_unit):
-                    pose_handle_base_world = self._forward_kinematics(self.goal_config)
-                    poses += [pose_handle_base_world]
-                    break
-                pose_handle_base_world = self._forward_kinematics(config_curr)
-                poses += [pose_handle_base_world]
-                config_curr += config_delta
-            else:
-                break
+        p_joints_world, q_joints_world = self.generate_trajectory_arrays(pose_handle_base_world, p_delta)
+        poses = [util.Pose(p_joint_world, q_joint_world) for p_joint_world, q_joint_world \
+                    in zip(p_joints_world, q_joints_world)]
         if debug:
             # draws the planned handle base trajectory
             self._draw_traj(poses, color)
             p.stepSimulation()
         return poses
 
+    def generate_trajectory_arrays(self, pose_handle_base_world, p_delta=0.01, max_len=400):
+        """ Same waypoints as generate_trajectory but computed in one batch
+        :param pose_handle_base_world: util.Pose, initial pose of the base of the handle
+        :param p_delta: scalar, the distance between trajectory waypoints
+        :param max_len: int, maximum number of waypoints
+        :return: (K,3) array of waypoint positions and (K,4) array of waypoint
+                    orientations (x,y,z,w)
+        """
+        # TODO: don't assume handle always starts at config = 0
+        config_curr = self._inverse_kinematics(*pose_handle_base_world)
+        config_dir_unit = self._config_dir(config_curr)
+        config_delta = p_delta*config_dir_unit
+
+        # cumsum accumulates sequentially so the configs are the same as repeatedly
+        # adding config_delta. stop at the first config past the goal and replace it
+        # with the goal config
+        configs = np.cumsum(np.concatenate([[config_curr], np.full(max_len-1, config_delta)]))
+        past_goal = (configs > self.goal_config) if (config_dir_unit == 1) \
+                        else (configs < self.goal_config)
+        if past_goal.any():
+            configs = np.append(configs[:np.argmax(past_goal)], self.goal_config)
+        return self._forward_kinematics_batch(configs)
+
     def get_policy_tuple(self):
         raise NotImplementedError('get_policy_tuple not implemented for policy \
                                     type '+self.type)
@@ -80,6 +88,10 @@ class Policy(object):
         raise NotImplementedError('_forward_kinematics function not implemented \
                                     for policy type '+self.type)
 
+    def _forward_kinematics_batch(self, configs):
+        raise NotImplementedError('_forward_kinematics_batch function not implemented \
+                                    for policy type '+self.type)
+
     def _inverse_kinematics(self, p_joint_world, q_joint_world):
         raise NotImplementedError('_inverse_kinematics function not implemented \
                                     for policy type '+self.type)
@@ -111,6 +123,24 @@ class Policy(object):
             dims += [policy_dims]
         return dims
 
+    @staticmethod
+    def get_bounds(policy_type):
+        """
+        :return: list of the bounds of each varied param (in the order of x, see
+                    get_policy_from_x)
+        """
+        return [param_data.bounds for param_data in Policy.get_param_data(policy_type).values()
+                    if param_data.varied]
+
+    @staticmethod
+    def sample_x(policy_type, n):
+        """ Sample the varied params of n policies uniformly from their bounds (the
+        same distribution as the varied params of _gen)
+        :return: np.array (n, d) of xs (see get_policy_from_x)
+        """
+        bounds = np.array(Policy.get_bounds(policy_type))
+        return np.random.uniform(bounds[:, 0], bounds[:, 1], size=(n, len(bounds)))
+
     @staticmethod
     def _gen(mech, x_dict={}):
         raise NotImplementedError('_gen not implemented for policy type ')
@@ -156,6 +186,17 @@ class Prismatic(Policy):
         q_joint_world = util.quaternion_from_matrix(self._M_origin_world)
         return util.Pose(p_joint_world, q_joint_world)
 
+    def _forward_kinematics_batch(self, configs):
+        """ Batched _forward_kinematics
+        :param configs: array of shape (K,), joint configurations
+        :return: (K,3) array of positions and (K,4) array of orientations (x,y,z,w)
+        """
+        configs = np.asarray(configs, dtype=float)
+        prismatic_dir_world = np.dot(self._M_origin_world[:3,:3], self.e)
+        p_joints_world = np.outer(configs, prismatic_dir_world) + self._M_origin_world[:3,3]
+        q_joint_world = util.quaternion_from_matrix(self._M_origin_world)
+        return p_joints_world, np.tile(q_joint_world, (len(configs), 1))
+
     def _inverse_kinematics(self, p_joint_world, q_joint_world):
         q_prismatic_dir = util.quaternion_from_euler(0.0, self.pitch, self.yaw)
         prismatic_dir = util.transformation([1., 0., 0.], [0., 0., 0.], q_prismatic_dir)
@@ -261,6 +302,7 @@ class Revolute(Policy):
         rot_axis = util.quaternion_from_euler(self.rot_axis_roll, self.rot_axis_pitch, self.rot_axis_yaw)
         rot_orn = [0., 0., 0., 1.] # rotation between handle frame and rotational axis
         self._M_center_world = util.pose_to_matrix(self.rot_center, rot_axis)
+        self._q_center_world = rot_axis
         self._M_radius_center = util.pose_to_matrix([self.rot_radius_x, 0., 0.], rot_orn)
         super(Revolute,self).__init__('Revolute')
 
@@ -272,6 +314,22 @@ class Revolute(Policy):
         q_joint_world = util.quaternion_from_matrix(M_joint_world)
         return util.Pose(p_joint_world, q_joint_world)
 
+    def _forward_kinematics_batch(self, configs):
+        """ Batched _forward_kinematics
+        :param configs: array of shape (K,), joint configurations
+        :return: (K,3) array of positions and (K,4) array of orientations (x,y,z,w)
+        """
+        configs = np.asarray(configs, dtype=float)
+        zeros = np.zeros_like(configs)
+        # the radius rotated about the z-axis of the center frame by -config
+        p_radius_center = self.rot_radius_x*np.stack([np.cos(-configs), np.sin(-configs), zeros], axis=1)
+        p_joints_world = np.dot(p_radius_center, self._M_center_world[:3,:3].T) + self._M_center_world[:3,3]
+        q_joints_z = np.stack([zeros, zeros, np.sin(-configs/2), np.cos(-configs/2)], axis=1)
+        q_joints_world = util.quat_multiply_batch(self._q_center_world, q_joints_z)
+        # same sign convention as util.quaternion_from_matrix
+        q_joints_world[q_joints_world[:,3] < 0] *= -1
+        return p_joints_world, q_joints_world
+
     def _inverse_kinematics(self, p_joint_world, q_joint_world):
         # this is only used at the beginning of generate trajectory to get the initial
         # configuration. for now hard code so starts at config=0 (when handle frame is
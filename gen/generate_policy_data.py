@@ -1,26 +1,71 @@
 import sys
+import os
+import glob
 import argparse
-from utils import util
+import multiprocessing
+from utils import util, dataset_store
 import numpy as np
 import argparse
 import pybullet as p
-from utils.setup_pybullet import setup_env, custom_bb_door, custom_bb_slider
+from utils.setup_pybullet import setup_env, connect, disconnect, custom_bb_door, custom_bb_slider
 from utils.util import read_from_file
 from actions import policies
-from gen.generator_busybox import Slider, Door, BusyBox
+from gen.generator_busybox import Mechanism, Slider, Door, BusyBox
 
 def generate_dataset(args, git_hash):
-    bb_dataset = get_bb_dataset(args.bb_fname, args.n_bbs, args.mech_types, args.max_mech, args.urdf_num)
+    """ Interact with each BusyBox. If args.fname is given the results of each
+    BusyBox are streamed to it (see util.ResultStreamWriter) as soon as they are
+    collected and a restarted run skips the BusyBoxes that are already in the file.
+    :return: list of lists of util.Results, or None if they were streamed to args.fname
+    """
+    bbs_fname = args.fname + '.bbs' if args.fname and args.n_samples > 0 else None
+    bb_dataset = get_bb_dataset(args.bb_fname, args.n_bbs, args.mech_types, args.max_mech,
+                                args.urdf_num, bbs_fname=bbs_fname)
     if args.n_samples == 0:
         return bb_dataset
 
+    if not args.fname:
+        if args.workers > 1:
+            return generate_dataset_parallel(args, git_hash, bb_dataset)
+        return generate_shard(args, git_hash, bb_dataset)
+
+    writer = util.ResultStreamWriter(args.fname)
+    # collect the results of the workers of an interrupted parallel run
+    merge_shard_streams(writer)
+    bb_indices = [i for i in range(len(bb_dataset)) if i not in writer.committed]
+    if len(writer.committed) > 0:
+        print('Already collected: %d\tRemaining: %d' % (len(writer.committed), len(bb_indices)))
+    bb_dataset = [bb_dataset[i] for i in bb_indices]
+    if len(bb_dataset) > 0:
+        if args.workers > 1:
+            generate_dataset_parallel(args, git_hash, bb_dataset, bb_indices, writer)
+        else:
+            generate_shard(args, git_hash, bb_dataset, writer=writer, bb_indices=bb_indices)
+    writer.close()
+    print('wrote results to '+args.fname)
+
+def generate_shard(args, git_hash, bb_dataset, shard_name='', writer=None, bb_indices=None):
+    """ Interact with each BusyBox in bb_dataset in a single pyBullet connection.
+    :param bb_dataset: list of lists of util.Results, the first Result of each
+                        list is used to build the BusyBox
+    :param shard_name: str, prepended to the progress output
+    :param writer: util.ResultStreamWriter, if given the results of each BusyBox
+                    are written to it instead of being returned
+    :param bb_indices: list of ints, index of each BusyBox of bb_dataset in the
+                        whole dataset (used as the writer index), defaults to
+                        range(len(bb_dataset))
+    :return: list of lists of util.Results, one list per BusyBox in bb_dataset
+                (empty if writer is given)
+    """
+    if bb_indices is None:
+        bb_indices = range(len(bb_dataset))
     results = []
     for (i, bb_results) in enumerate(bb_dataset):
         bb = BusyBox.bb_from_result(bb_results[0])
         image_data, gripper = setup_env(bb, args.viz, args.debug)
         bb_results = []
         for j in range(args.n_samples):
-            sys.stdout.write("\rProcessing sample %i/%i for busybox %i/%i" % (j+1, args.n_samples, i+1, args.n_bbs))
+            sys.stdout.write("\r%sProcessing sample %i/%i for busybox %i/%i" % (shard_name, j+1, args.n_samples, i+1, len(bb_dataset)))
             for mech in bb._mechanisms:
                 # generate either a random or model-based policy and goal configuration
                 policy = policies.generate_policy(mech)
@@ -42,12 +87,89 @@ def generate_dataset(args, git_hash):
                 bb_results.append(result)
 
                 gripper.reset(mech)
-        results.append(bb_results)
-        p.disconnect()
+        if writer is None:
+            results.append(bb_results)
+        else:
+            writer.write(bb_indices[i], bb_results)
+        disconnect(gripper.client)
     print()
     return results
 
-def get_bb_dataset(bb_fname, n_bbs, mech_types, max_mech, urdf_num):
+def shard_stream_fname(fname, shard_i):
+    return '%s.shard%i' % (fname, shard_i)
+
+def merge_shard_streams(writer):
+    """ Append the records of the worker streams of writer's file (see
+    generate_dataset_parallel) to writer and delete them
+    """
+    for shard_fname in sorted(glob.glob(glob.escape(writer.file_name)+'.shard*')):
+        for bb_i, bb_results in util.iter_result_stream(shard_fname):
+            if bb_i not in writer.committed:
+                writer.write(bb_i, bb_results)
+        os.remove(shard_fname)
+
+def _generate_shard_worker(shard_args):
+    """ Entry point of a worker process. Each worker has its own pyBullet DIRECT
+    connection (the module level client is per-process) and, when streaming, its
+    own result stream.
+    """
+    shard_i, args, git_hash, bb_dataset, bb_indices, seed = shard_args
+    # forked workers inherit the parent's random state, so reseed each shard
+    np.random.seed(seed)
+    shard_name = '[shard %i] ' % shard_i
+    if not args.fname:
+        return generate_shard(args, git_hash, bb_dataset, shard_name=shard_name)
+    writer = util.ResultStreamWriter(shard_stream_fname(args.fname, shard_i))
+    generate_shard(args, git_hash, bb_dataset, shard_name=shard_name, writer=writer,
+                   bb_indices=bb_indices)
+    writer.close()
+    return []
+
+def generate_dataset_parallel(args, git_hash, bb_dataset, bb_indices=None, writer=None):
+    """ Split bb_dataset into args.workers contiguous shards and interact with
+    each shard in its own process. The shard results are concatenated in the
+    order of bb_dataset. If writer is given, each worker streams its results to
+    its own file next to writer's file and they are merged into writer at the end.
+    :param bb_indices: list of ints, index of each BusyBox of bb_dataset in the
+                        whole dataset, defaults to range(len(bb_dataset))
+    """
+    if args.viz:
+        raise Exception('cannot visualize the simulation when running multiple workers')
+    if bb_indices is None:
+        bb_indices = list(range(len(bb_dataset)))
+
+    # don't fork the parent's setup_env connection (eg. from get_bb_dataset) into the
+    # workers, clients the caller connected itself are left alone
+    disconnect()
+
+    n_shards = min(args.workers, len(bb_dataset))
+    bounds = np.linspace(0, len(bb_dataset), n_shards+1).astype(int)
+    seeds = np.random.randint(0, 2**31-1, size=n_shards)
+    shard_args = [(i, args, git_hash, bb_dataset[bounds[i]:bounds[i+1]],
+                    bb_indices[bounds[i]:bounds[i+1]], seeds[i])
+                    for i in range(n_shards)]
+
+    with multiprocessing.Pool(processes=n_shards) as pool:
+        shard_results = pool.map(_generate_shard_worker, shard_args)
+
+    if writer is not None:
+        merge_shard_streams(writer)
+
+    results = []
+    for shard_result in shard_results:
+        results += shard_result
+    return results
+
+def get_bb_dataset(bb_fname, n_bbs, mech_types, max_mech, urdf_num, bbs_fname=None):
+    """
+    :param urdf_num: unused, urdf files are cached by busybox contents (kept for old scripts)
+    :param bbs_fname: str, if given and bb_fname isn't, the randomly generated
+                        BusyBoxes are saved to this file and read back from it by
+                        later calls (eg. when resuming an interrupted run)
+    """
+    if (bb_fname == '' or bb_fname is None) and bbs_fname is not None \
+        and os.path.isfile(bbs_fname):
+        bb_fname = bbs_fname
     # Create a dataset of busyboxes.
     if bb_fname == '' or bb_fname is None:
         print('Creating Busyboxes.')
@@ -60,37 +182,68 @@ def get_bb_dataset(bb_fname, n_bbs, mech_types, max_mech, urdf_num):
         for _ in range(n_bbs):
             # TODO: i think there is a bug here...
             bb = BusyBox.generate_random_busybox(max_mech=max_mech,
-                                                    mech_types=mech_classes,
-                                                    urdf_tag=urdf_num)
+                                                    mech_types=mech_classes)
             mechanism_params = bb._mechanisms[0].get_mechanism_tuple()
             image_data, gripper = setup_env(bb, False, False)
             bb_dataset.append([util.Result(None, mechanism_params, None, None, None,
                                 None, image_data, None)])
         print('BusyBoxes created.')
+        if bbs_fname is not None:
+            # write then rename so an interrupted write isn't read back later
+            util.write_to_file(bbs_fname+'.tmp', bb_dataset)
+            os.replace(bbs_fname+'.tmp', bbs_fname)
+    elif dataset_store.is_dataset(bb_fname):
+        bb_dataset = dataset_store.load_dataset(bb_fname).get_bb_results(n_bbs)
     else:
         # Load in a file with predetermined BusyBoxes.
         bb_dataset = read_from_file(bb_fname)[:n_bbs]
     return bb_dataset
 
 
-def get_true_ys(X_pred, mech, policy_params):
-    Y_pred = np.zeros((X_pred.shape[0]))
-    viz = False
-    debug = False
-    for i, x in enumerate(X_pred):
-        policy = policies.get_policy_from_x(mech, x, policy_params)
+class GroundTruthEvaluator(object):
+    def __init__(self, mech, viz=False, debug=False):
+        """
+        Evaluates the true net motion of many policies on a single mechanism. A copy
+        of the mechanism is loaded once, in its own pyBullet client, and the
+        mechanism is reset between trials instead of rebuilding the environment.
+        :param mech: gen.generator_busybox.Mechanism to evaluate policies on (it
+                        is not modified and its simulation is left untouched)
+        """
         width, height = 0.6, 0.6
-        bb = BusyBox.get_busybox(width, height, [mech])
-        _, gripper = setup_env(bb, viz, debug)
+        self.mech = Mechanism.mech_from_mech_params(mech.get_mechanism_tuple())
+        self.bb = BusyBox.get_busybox(width, height, [self.mech])
+        self.client = connect(viz)
+        _, self.gripper = setup_env(self.bb, viz, debug, client=self.client, render=False)
+        self.debug = debug
 
-        # calculate trajectory
-        pose_handle_base_world = mech.get_pose_handle_base_world()
-        traj = policy.generate_trajectory(pose_handle_base_world, debug)
+    def evaluate(self, X, policy_params):
+        """
+        :param X: np.array of shape (N, d), each row are the varied params of a policy
+        :param policy_params: actions.policies.PolicyParams, used for the type and
+                                param_data of the policies in X
+        :return: np.array of shape (N,), the net motion of each policy
+        """
+        Y = np.zeros((X.shape[0]))
+        for i, x in enumerate(X):
+            self.gripper.reset(self.mech)
+            policy = policies.get_policy_from_x(self.mech, x, policy_params)
 
-        # execute trajectory
-        _, net_motion, _ = gripper.execute_trajectory(traj, mech, policy.type, False)
-        Y_pred[i] = net_motion
-        gripper.reset(mech)
+            # calculate trajectory
+            pose_handle_base_world = self.mech.get_pose_handle_base_world()
+            traj = policy.generate_trajectory(pose_handle_base_world, self.debug)
+
+            # execute trajectory
+            _, net_motion, _ = self.gripper.execute_trajectory(traj, self.mech, policy.type, self.debug)
+            Y[i] = net_motion
+        return Y
+
+    def close(self):
+        disconnect(self.client)
+
+def get_true_ys(X_pred, mech, policy_params):
+    evaluator = GroundTruthEvaluator(mech)
+    Y_pred = evaluator.evaluate(X_pred, policy_params)
+    evaluator.close()
     return Y_pred
 
 if __name__ == '__main__':
@@ -101,9 +254,13 @@ if __name__ == '__main__':
     parser.add_argument('--n-bbs', type=int, default=5) # number bbs to generate
     parser.add_argument('--max-mech', type=int, default=1) # mechanisms per bb
     parser.add_argument('--mech-types', nargs='+', default=['slider'], type=str)
-    parser.add_argument('--fname', type=str) # give filename if want to save to file
-    # if running multiple gens, give then a urdf_num so the correct urdf is read from/written to
+    # give filename if want to save to file. results are appended as each busybox is done,
+    # rerun with the same arguments to resume an interrupted run
+    parser.add_argument('--fname', type=str)
+    # unused, urdf files are now cached by busybox contents (kept for old scripts)
     parser.add_argument('--urdf-num', type=int, default=0)
+    # number of processes to split the busyboxes between, each with its own pybullet client
+    parser.add_argument('--workers', type=int, default=1)
     # desired goal config represented as a percentage of the max config, if unused then random config is generated
     parser.add_argument('--bb-fname', type=str)
     args = parser.parse_args()
@@ -120,5 +277,7 @@ if __name__ == '__main__':
         print('install gitpython to save git hash to results')
         git_hash = None
     results = generate_dataset(args, git_hash)
-    if args.fname:
+    # results are streamed to args.fname while they are generated unless only
+    # generating BusyBoxes
+    if args.fname and args.n_samples == 0:
         util.write_to_file(args.fname, results)
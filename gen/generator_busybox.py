@@ -8,6 +8,9 @@ import cv2
 from actions.gripper import Gripper
 from utils import util
 from collections import namedtuple
+import os
+
+URDF_CACHE_DIR = 'models/urdf_cache/'
 
 MechanismParams = namedtuple('MechanismParams', 'type params')
 SliderParams = namedtuple('SliderParams', 'x_offset z_offset range axis')
@@ -30,6 +33,9 @@ class Mechanism(object):
     def _get_bb_id(self):
         return self._bb.get_bb_id()
 
+    def _get_client(self):
+        return self._bb.get_client()
+
     def _get_handle_id(self):
         assert self._handle_id is not None, 'BusyBox.set_mechanism_ids() must be called to access pyBullet ids'
         return self._handle_id
@@ -43,7 +49,7 @@ class Mechanism(object):
     def get_pose_handle_base_world(self):
         handle_id = self._get_handle_id()
         bb_id = self._get_bb_id()
-        pose_handle_world = util.Pose(*p.getLinkState(bb_id, handle_id)[:2])
+        pose_handle_world = util.Pose(*p.getLinkState(bb_id, handle_id, physicsClientId=self._get_client())[:2])
         p_handle_base = [0., 0., self.handle_length/2]
         p_handle_base_world = util.transformation(p_handle_base, *pose_handle_world)
         return util.Pose(p_handle_base_world, pose_handle_world.q)
@@ -62,12 +68,13 @@ class Mechanism(object):
     def get_handle_pose(self):
         handle_id = self._get_handle_id()
         bb_id = self._get_bb_id()
-        return util.Pose(*p.getLinkState(bb_id, handle_id)[:2])
+        return util.Pose(*p.getLinkState(bb_id, handle_id, physicsClientId=self._get_client())[:2])
 
     def get_contact_points(self, gripper_id):
         handle_id = self._get_handle_id()
         bb_id = self._get_bb_id()
-        return p.getContactPoints(gripper_id, bb_id, linkIndexB=handle_id)
+        return p.getContactPoints(gripper_id, bb_id, linkIndexB=handle_id,
+                                  physicsClientId=self._get_client())
 
     @staticmethod
     def mech_from_mech_params(mech_params):
@@ -83,8 +90,6 @@ class Mechanism(object):
 
 
 class Slider(Mechanism):
-    n_sliders = 0
-
     def __init__(self, x_offset, z_offset, range, axis, color, bb_thickness=0.05):
         """
 
@@ -96,8 +101,9 @@ class Slider(Mechanism):
         """
         super(Slider, self).__init__('Slider')
 
-        name = Slider.n_sliders
-        Slider.n_sliders += 1
+        # names only depend on the params so the urdf of a busybox only depends on
+        # its contents (two mechanisms on a busybox can't have the same params)
+        name = util.params_hash([x_offset, z_offset, range, axis])[:10]
 
         handle_radius = 0.02
         slider_handle_name = 'slider_{0}_handle'.format(name)
@@ -170,6 +176,7 @@ class Slider(Mechanism):
 
         self.handle_name = slider_handle_name
         self.track_name = slider_track_name
+        self.color = color
         self.origin = (x_offset, z_offset)
         self.range = range
         self.handle_radius = handle_radius
@@ -199,7 +206,7 @@ class Slider(Mechanism):
     def reset(self):
         handle_id = self._get_handle_id()
         bb_id = self._get_bb_id()
-        p.resetJointState(bb_id, handle_id, 0.0)
+        p.resetJointState(bb_id, handle_id, 0.0, physicsClientId=self._get_client())
 
     @staticmethod
     def random(width, height, bb_thickness=0.05):
@@ -221,12 +228,10 @@ class Slider(Mechanism):
         return Slider(x_offset, z_offset, range, axis, color, bb_thickness)
 
 class Door(Mechanism):
-    n_doors = 0
-
     def __init__(self, door_offset, door_size, handle_offset_z, flipped, color, bb_thickness=0.05):
         super(Door, self).__init__('Door')
-        name = Door.n_doors
-        Door.n_doors += 1
+        # see Slider for naming
+        name = util.params_hash([door_offset, door_size, handle_offset_z, flipped])[:10]
 
         dir = 1.0
         if flipped: dir = -1.0
@@ -308,6 +313,7 @@ class Door(Mechanism):
 
         self.handle_name = door_handle_name
         self.door_base_name = door_base_name
+        self.color = color
         self.origin = door_offset
         self.door_size = door_size
         self.handle_offset_z = handle_offset_z
@@ -346,7 +352,7 @@ class Door(Mechanism):
     def get_rot_center(self):
         bb_id = self._get_bb_id()
         door_base_id = self._get_door_base_id()
-        return p.getLinkState(bb_id, door_base_id)[0]
+        return p.getLinkState(bb_id, door_base_id, physicsClientId=self._get_client())[0]
 
     def get_max_net_motion(self):
         motion_radius = self.door_size[0] - (self.handle_radius + self.handle_offset_x)
@@ -361,7 +367,7 @@ class Door(Mechanism):
     def reset(self):
         door_base_id = self._get_door_base_id()
         bb_id = self._get_bb_id()
-        p.resetJointState(bb_id, door_base_id, 0.0)
+        p.resetJointState(bb_id, door_base_id, 0.0, physicsClientId=self._get_client())
 
     @staticmethod
     def random(width, height, bb_thickness=0.05):
@@ -393,6 +399,7 @@ class BusyBox(object):
         self.bb_thickness = bb_thickness
         self.file_name = file_name
         self._bb_id = None # set with mechanism ids
+        self._client = None # pyBullet physics client the busybox is loaded in, set with mechanism ids
 
     def _create_skeleton(self, width, height, bb_thickness=0.05):
         """
@@ -457,20 +464,53 @@ class BusyBox(object):
 
     def project_onto_backboard(self, pos):
         bb_id = self.get_bb_id()
-        p_bb_base_w = p.getLinkState(bb_id,0)[0]
+        p_bb_base_w = p.getLinkState(bb_id, 0, physicsClientId=self.get_client())[0]
         return [pos[0], p_bb_base_w[1]+self.bb_thickness/2, pos[2]]
 
+    def get_hash(self):
+        """
+        :return: str, a hash of the busybox dimensions and of the parameters and
+                    colors of its mechanisms (does not depend on the mechanism names)
+        """
+        mechs = [[mech.get_mechanism_tuple(), mech.color] for mech in self._mechanisms]
+        return util.params_hash([self.width, self.height, self.bb_thickness, mechs])
+
+    def write_urdf(self):
+        """
+        Write the busybox's urdf to URDF_CACHE_DIR, named by get_hash(), and point
+        file_name at it. If that file already exists the urdf isn't generated again.
+        Files are written through a temporary file so concurrent processes never
+        read or clobber a partial urdf.
+        """
+        file_name = URDF_CACHE_DIR + 'busybox_' + self.get_hash() + '.urdf'
+        if not os.path.isfile(file_name):
+            os.makedirs(URDF_CACHE_DIR, exist_ok=True)
+            tmp_file_name = '%s.%i.tmp' % (file_name, os.getpid())
+            with open(tmp_file_name, 'w') as handle:
+                handle.write(self.get_urdf())
+            os.replace(tmp_file_name, file_name)
+        self.file_name = file_name
+
     def get_bb_id(self):
         assert self._bb_id is not None, 'BusyBox.set_mechanism_ids() must be called to access pyBullet ids'
         return self._bb_id
 
-    def set_mechanism_ids(self, bb_id):
+    def get_client(self):
+        assert self._client is not None, 'BusyBox.set_mechanism_ids() must be called to access pyBullet ids'
+        return self._client
+
+    def set_mechanism_ids(self, bb_id, client=0):
+        """
+        :param bb_id: the pyBullet body id of the loaded busybox
+        :param client: the pyBullet physics client the busybox was loaded in
+        """
         self._bb_id = bb_id
+        self._client = client
         bb_id = self.get_bb_id()
-        num_joints = p.getNumJoints(bb_id)
+        num_joints = p.getNumJoints(bb_id, physicsClientId=client)
         # joint_id 0 is the busybox back_link
         for joint_id in range(1, num_joints):
-            joint_info = p.getJointInfo(bb_id, joint_id)
+            joint_info = p.getJointInfo(bb_id, joint_id, physicsClientId=client)
             link_name = joint_info[12]
             set = False
             for mech in self._mechanisms:
@@ -498,15 +538,17 @@ class BusyBox(object):
 
     def get_center_pos(self):
         bb_id = self.get_bb_id()
-        return p.getLinkState(bb_id,0)[0]
+        return p.getLinkState(bb_id, 0, physicsClientId=self.get_client())[0]
 
     def set_joint_control_mode(self, mode, maxForce):
         bb_id = self.get_bb_id()
-        for jx in range(0, p.getNumJoints(bb_id)):
+        client = self.get_client()
+        for jx in range(0, p.getNumJoints(bb_id, physicsClientId=client)):
             p.setJointMotorControl2(bodyUniqueId=bb_id,
                                     jointIndex=jx,
                                     controlMode=mode,
-                                    force=maxForce)
+                                    force=maxForce,
+                                    physicsClientId=client)
 
     @staticmethod
     def _check_collision(width, height, mechs, mech):
@@ -566,23 +608,21 @@ class BusyBox(object):
                     print('generated a Busybox with no Mechanisms')
                 continue
 
-        bb_file = 'models/busybox' + str(urdf_tag) + '.urdf'
-        bb = BusyBox(width, height, mechs, bb_thickness, bb_file)
-
-        with open(bb_file, 'w') as handle:
-            handle.write(bb.get_urdf())
+        bb = BusyBox(width, height, mechs, bb_thickness)
+        bb.write_urdf()
         return bb
 
     @staticmethod
     def get_busybox(width, height, mechs, bb_thickness=0.05, urdf_tag=''):
-        bb_file = 'models/busybox' + urdf_tag + '.urdf'
-        bb = BusyBox(width, height, mechs, bb_thickness, bb_file)
+        """
+        :param urdf_tag: unused, urdf files are named by the busybox contents (see
+                            BusyBox.write_urdf) so concurrent jobs can't collide
+        """
+        bb = BusyBox(width, height, mechs, bb_thickness)
         for mech in mechs:
             if BusyBox._check_collision(width, height, mechs, mech):
                 raise Exception('generated a BusyBox with collisions')
-        with open(bb_file, 'w') as handle:
-            handle.write(bb.get_urdf())
-
+        bb.write_urdf()
         return bb
 
     @staticmethod
@@ -1,8 +1,9 @@
-import pickle
 import argparse
+import itertools
 import matplotlib.pyplot as plt
 import numpy as np
 from gen.generator_busybox import BusyBox
+from utils import util
 
 def plot_result(result, ax):
     cmap = plt.get_cmap('viridis')
@@ -52,6 +53,16 @@ def viz_circles_datasets(full_sets):
 
     plt.show()
 
+def read_flat_results(file_name):
+    """ Reads a dataset (a pickle or a result stream) as a flat list of util.Results,
+    datasets of lists of results per BusyBox are concatenated
+    """
+    data = util.read_from_file(file_name)
+    if len(data) > 0 and isinstance(data[0], (list, tuple)) and \
+        not isinstance(data[0], util.Result):
+        data = list(itertools.chain.from_iterable(data))
+    return data
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--mode', choices=['single', 'multiple'], required=True)
@@ -68,15 +79,13 @@ if __name__ == '__main__':
         import pdb; pdb.set_trace()
 
     if args.dataset:
-        with open(args.dataset, 'rb') as handle:
-            data = pickle.load(handle)
+        data = read_flat_results(args.dataset)
         for n in range(0, len(data)-args.step, args.step):
             viz_circles(data[n:n+args.step])
     else:
         all_data = []
         for dataset in args.datasets:
-            with open(dataset, 'rb') as handle:
-                data = pickle.load(handle)
+            data = read_flat_results(dataset)
             all_data += [data]
         #print(len(data))
         first_sets = []
@@ -1,5 +1,4 @@
 # Given a file setup the dataloaders.
-import copy
 import numpy as np
 import random
 import pickle
@@ -12,54 +11,78 @@ import matplotlib.pyplot as plt
 from utils import util
 
 class CustomSampler(Sampler):
-    def __init__(self, items, batch_size):
+    def __init__(self, items, batch_size, seed=None, num_replicas=1, rank=0, group_ixs=None):
+        """ Yields batches of indices where each batch only has a single policy type.
+        The batches of an epoch are planned up front: the indices of each type are
+        permuted and split into batches, then the order of all batches is permuted.
+        :param items: list of dicts with a 'type' key (see parse_pickle_file)
+        :param seed: int, if given epoch e is planned with the seed (seed, e) and the
+                        epoch advances after each iteration, else np.random is used
+        :param num_replicas: int, number of data-parallel ranks splitting each epoch
+        :param rank: int, this rank's index in [0, num_replicas), every rank gets the
+                        same number of batches (padded with the epoch's first batches)
+        :param group_ixs: list of ints, the group (eg. BusyBox image) of each item. If
+                        given the permuted indices of each type are reordered by a
+                        random order of the groups before splitting, so each batch
+                        spans as few groups as possible
+        """
         self.batch_size = batch_size
+        self.group_ixs = None if group_ixs is None else np.array(group_ixs, dtype=np.int64)
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
 
         self.types = []
-        self.sorted_indices = {}
-        for ix, item in enumerate(items):
-            k = item['type']
-            if k not in self.types:
-                self.types.append(k)
-                self.sorted_indices[k] = []
-            self.sorted_indices[k].append(ix)
+        for item in items:
+            if item['type'] not in self.types:
+                self.types.append(item['type'])
+        type_ixs = np.array([self.types.index(item['type']) for item in items], dtype=np.int64)
+        self.sorted_indices = {k: np.flatnonzero(type_ixs == i) for i, k in enumerate(self.types)}
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_batches(self):
+        """
+        :return: list of np.arrays, the batches of indices of the current epoch for
+                    this rank
+        """
+        if self.seed is None:
+            rng = np.random
+        else:
+            rng = np.random.RandomState([self.seed, self.epoch])
+
+        batches = []
+        for k in self.types:
+            indices = rng.permutation(self.sorted_indices[k])
+            if self.group_ixs is not None and len(indices) > 0:
+                group_order = rng.permutation(self.group_ixs.max()+1)
+                indices = indices[np.argsort(group_order[self.group_ixs[indices]], kind='stable')]
+            batches += np.split(indices, np.arange(self.batch_size, len(indices), self.batch_size))
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        if self.num_replicas > 1:
+            n_batches = len(self) * self.num_replicas
+            batches = [batches[i % len(batches)] for i in range(n_batches)][self.rank::self.num_replicas]
+        return batches
 
     def __iter__(self):
-        # Shuffle each policy class individually and create an iterator for each.
-        iters = {}
-        valid_types = copy.deepcopy(self.types)
-        for k in self.sorted_indices:
-            np.random.shuffle(self.sorted_indices[k])
-            iters[k] = iter(self.sorted_indices[k])
-
-        # Randomly choose a class until we've iterated through everything.
-        while len(valid_types) > 0:
-            # Choose a policy type.
-            k = np.random.choice(valid_types)
-
-            # Create a batch of batch_size.
-            batch = []
-            for _ in range(self.batch_size):
-                # Check if we've used all the data from a policy iterator.
-                try:
-                    ix = next(iters[k])
-                except:
-                    valid_types.remove(k)
-                    break
-                batch.append(ix)
-            # Yield the batch.
-            if len(batch) > 0:
-                yield batch
+        batches = self.get_batches()
+        if self.seed is not None:
+            self.epoch += 1
+        for batch in batches:
+            yield batch.tolist()
 
     def __len__(self):
         """
         Batches consist of a single policy type.
-        :return: The number of batches in the dataset.
+        :return: The number of batches in the dataset (for this rank).
         """
         n = 0
         for v in self.sorted_indices.values():
             n += (len(v) + self.batch_size - 1) // self.batch_size
-        return n
+        return (n + self.num_replicas - 1) // self.num_replicas
 
 
 def imshow(img):
@@ -72,6 +95,27 @@ def imshow(img):
     plt.show()
 
 
+IMAGE_TRANSFORM = transforms.Compose([transforms.ToTensor(),
+                                      transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))])
+
+
+def get_np_image(image_data):
+    """
+    :param image_data: util.ImageData
+    :return: uint8 np.array (h, w, 3)
+    """
+    w, h, im = image_data
+    return np.array(im, dtype=np.uint8).reshape(h, w, 3)[:, :, 0:3]
+
+
+def get_image_tensor(image_data):
+    """ The normalized image tensor (3, h, w) the models take as input, same as the
+    images of a PolicyDataset
+    :param image_data: util.ImageData
+    """
+    return IMAGE_TRANSFORM(get_np_image(image_data))
+
+
 class PolicyDataset(Dataset):
     def __init__(self, items):
         super(PolicyDataset, self).__init__()
@@ -80,29 +124,161 @@ class PolicyDataset(Dataset):
         self.tensors = [torch.tensor(item['params']) for item in items]
         self.ys = [torch.tensor([item['y']]) for item in items]
 
-        downsample = transforms.Compose([transforms.ToPILImage(),
-                                         transforms.Resize(25),
-                                         transforms.Grayscale(),
-                                         transforms.ToTensor()])
-        tt = transforms.Compose([transforms.ToTensor(),
-                                 transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))])
-        self.images = []
-        self.downsampled_images = []
-
+        # all interactions with a BusyBox share the same image object, so only
+        # transform each unique image once and have the items reference it
+        self.unique_images = []
+        self.image_ixs = []
+        self._np_images = []
+        unique_ixs = {}
         for item in items:
-            w, h, im = item['image']
-            np_im = np.array(im, dtype=np.uint8).reshape(h, w, 3)[:, :, 0:3]
-            self.images.append(tt(np_im))
-            self.downsampled_images.append(downsample(np_im))
+            key = id(item['image'])
+            if key not in unique_ixs:
+                np_im = get_np_image(item['image'])
+                unique_ixs[key] = len(self.unique_images)
+                self._np_images.append(np_im)
+                self.unique_images.append(IMAGE_TRANSFORM(np_im))
+            self.image_ixs.append(unique_ixs[key])
+        self.images = [self.unique_images[ix] for ix in self.image_ixs]
+        self._downsampled_images = None
         # imshow(torchvision.utils.make_grid(self.images[0:10]))
-        # imshow(torchvision.utils.make_grid(self.downsampled_images[0:10]))
+
+        # contiguous copies so a whole batch is gathered with one index operation
+        # (see get_batch). params are zero padded to the largest policy dimension
+        self.dims = [len(tensor) for tensor in self.tensors]
+        dtype = self.tensors[0].dtype if len(items) > 0 else torch.float
+        self.params_tensor = torch.zeros(len(items), max(self.dims, default=0), dtype=dtype)
+        for i, tensor in enumerate(self.tensors):
+            self.params_tensor[i, :self.dims[i]] = tensor
+        self.ys_tensor = torch.cat(self.ys).view(-1, 1) if len(items) > 0 else torch.zeros(0, 1)
+        self.image_stack = torch.stack(self.unique_images) if len(items) > 0 else torch.zeros(0)
+        self.image_ixs_tensor = torch.tensor(self.image_ixs, dtype=torch.long)
+        # uint8 stack of the unique images, only made when the dataset is shared
+        self._np_image_stack = None
+
+    def share_memory_(self):
+        """ Moves the stacked tensors to shared memory so the dataset can be sent to
+        other processes (eg. the workers of learning.train_parallel) without copying
+        the data. Only the stacked tensors are pickled (see __getstate__)
+        """
+        if self._np_image_stack is None:
+            self._np_image_stack = self._stack_np_images()
+        for tensor in [self.params_tensor, self.ys_tensor, self.image_stack,
+                       self.image_ixs_tensor, self._np_image_stack]:
+            tensor.share_memory_()
+        return self
+
+    def _stack_np_images(self):
+        if len(self._np_images) == 0:
+            return torch.zeros(0, dtype=torch.uint8)
+        return torch.tensor(np.stack(self._np_images))
+
+    def __getstate__(self):
+        np_image_stack = self._np_image_stack
+        if np_image_stack is None:
+            np_image_stack = self._stack_np_images()
+        return {'types': [item['type'] for item in self.items],
+                'dims': self.dims,
+                'params_tensor': self.params_tensor,
+                'ys_tensor': self.ys_tensor,
+                'image_stack': self.image_stack,
+                'image_ixs_tensor': self.image_ixs_tensor,
+                'np_image_stack': np_image_stack}
+
+    def __setstate__(self, state):
+        """ Rebuild the per-item lists as views of the stacked tensors
+        """
+        self.dims = state['dims']
+        self.params_tensor = state['params_tensor']
+        self.ys_tensor = state['ys_tensor']
+        self.image_stack = state['image_stack']
+        self.image_ixs_tensor = state['image_ixs_tensor']
+        self._np_image_stack = state['np_image_stack']
+        self._downsampled_images = None
+
+        self.image_ixs = self.image_ixs_tensor.tolist()
+        self.unique_images = list(self.image_stack)
+        self.images = [self.unique_images[ix] for ix in self.image_ixs]
+        self.tensors = [self.params_tensor[i, :dim] for i, dim in enumerate(self.dims)]
+        self.ys = list(self.ys_tensor)
+        self._np_images = list(self._np_image_stack.numpy())
+        image_data = [util.ImageData(np_im.shape[1], np_im.shape[0], np_im)
+                        for np_im in self._np_images]
+        self.items = [{'type': policy_type,
+                       'params': tensor.tolist(),
+                       'image': image_data[image_ix],
+                       'y': y.item()}
+                        for policy_type, tensor, image_ix, y in
+                        zip(state['types'], self.tensors, self.image_ixs, self.ys)]
+
+    @property
+    def downsampled_images(self):
+        """ Grayscale downsampled images of each item, only computed when used
+        """
+        if self._downsampled_images is None:
+            downsample = transforms.Compose([transforms.ToPILImage(),
+                                             transforms.Resize(25),
+                                             transforms.Grayscale(),
+                                             transforms.ToTensor()])
+            unique_downsampled = [downsample(np_im) for np_im in self._np_images]
+            self._downsampled_images = [unique_downsampled[ix] for ix in self.image_ixs]
+            # imshow(torchvision.utils.make_grid(self._downsampled_images[0:10]))
+        return self._downsampled_images
 
     def __getitem__(self, index):
-        return self.items[index]['type'], self.tensors[index], self.images[index], self.ys[index], self.downsampled_images[index]
+        if isinstance(index, list):
+            return self.get_batch(index)
+        return self.items[index]['type'], self.tensors[index], self.images[index], self.ys[index]
+
+    def get_batch(self, indices, share_images=False):
+        """ Same as collating the items at indices, all items must have the same
+        policy type (as in the batches of CustomSampler)
+        :param indices: list of ints
+        :param share_images: bool, if True each unique image of the batch is only
+                    returned once along with the index of each item's image (see
+                    DistanceRegressor.forward_shared)
+        :return: list of policy types, params tensor (len(indices), dim), image
+                    tensor (len(indices), 3, h, w) and y tensor (len(indices), 1).
+                    If share_images the image tensor is (n_unique, 3, h, w) and is
+                    followed by a LongTensor (len(indices),) of image indices
+        """
+        ixs = torch.tensor(indices, dtype=torch.long)
+        policy_type = self.items[indices[0]]['type']
+        dim = self.dims[indices[0]]
+        batch_image_ixs = self.image_ixs_tensor[ixs]
+        if share_images:
+            unique_ixs, batch_image_ixs = torch.unique(batch_image_ixs, return_inverse=True)
+            images = (torch.index_select(self.image_stack, 0, unique_ixs), batch_image_ixs)
+        else:
+            images = (torch.index_select(self.image_stack, 0, batch_image_ixs),)
+        return (([policy_type]*len(indices), torch.index_select(self.params_tensor, 0, ixs)[:, :dim])
+                + images + (torch.index_select(self.ys_tensor, 0, ixs),))
 
     def __len__(self):
         return len(self.items)
 
+class PolicySubset(Dataset):
+    def __init__(self, dataset, indices):
+        """ A view of some of the items of a PolicyDataset that shares its tensors
+        :param dataset: PolicyDataset
+        :param indices: list of ints, the indices of dataset in this subset
+        """
+        super(PolicySubset, self).__init__()
+        self.dataset = dataset
+        self.indices = np.array(indices, dtype=np.int64)
+        self.items = [dataset.items[i] for i in self.indices]
+        self.image_ixs = [dataset.image_ixs[i] for i in self.indices]
+
+    def __getitem__(self, index):
+        if isinstance(index, list):
+            return self.get_batch(index)
+        return self.dataset[int(self.indices[index])]
+
+    def get_batch(self, indices, share_images=False):
+        return self.dataset.get_batch(self.indices[indices].tolist(), share_images=share_images)
+
+    def __len__(self):
+        return len(self.indices)
+
 def parse_pickle_file(results):
     """
     Pass in a list of utils.util.Results.
@@ -141,42 +317,92 @@ def create_data_splits(data, val_pct=0.15, test_pct=0.0):
     return train_data, val_data, test_data
 
 
-def setup_data_loaders(data, batch_size=128, use_cuda=True, small_train=0, single_set=False):
+def _unwrap_batch(batch):
+    # the sampler yields whole batches of indices which PolicyDataset.get_batch
+    # already collates, so the DataLoader batches are of size 1
+    return batch[0]
 
-    kwargs = {'num_workers': 0,
-              'pin_memory': use_cuda}
 
+class SharedImageBatches(Dataset):
+    def __init__(self, dataset):
+        """ Fetches batches of a PolicyDataset or PolicySubset with share_images=True
+        """
+        super(SharedImageBatches, self).__init__()
+        self.dataset = dataset
+        self.items = dataset.items
+        self.image_ixs = dataset.image_ixs
+
+    def __getitem__(self, indices):
+        return self.dataset.get_batch(indices, share_images=True)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def create_loader(dataset, batch_size, num_workers=0, pin_memory=False, seed=None,
+                    num_replicas=1, rank=0, share_images=False):
+    """ A DataLoader that fetches each batch of CustomSampler with a single
+    PolicyDataset.get_batch call
+    :param num_workers: int, if > 0 batches are fetched (and prefetched) in
+                        this many worker processes
+    :param seed, num_replicas, rank: see CustomSampler
+    :param share_images: bool, if True batches are grouped by BusyBox and have the
+                        (types, params, unique images, image indices, ys) format
+                        of get_batch(share_images=True)
+    """
+    if share_images:
+        dataset = SharedImageBatches(dataset)
+    sampler = CustomSampler(dataset.items, batch_size, seed=seed,
+                            num_replicas=num_replicas, rank=rank,
+                            group_ixs=dataset.image_ixs if share_images else None)
+    return torch.utils.data.DataLoader(dataset=dataset,
+                                       batch_size=1,
+                                       sampler=sampler,
+                                       collate_fn=_unwrap_batch,
+                                       num_workers=num_workers,
+                                       pin_memory=pin_memory)
+
+
+def setup_data_loaders(data, batch_size=128, use_cuda=True, small_train=0, single_set=False,
+                        num_workers=0, seed=None, num_replicas=1, rank=0, n_items=None,
+                        share_images=False):
+    """
+    :param data: list of dicts (see parse_pickle_file) or a PolicyDataset, the
+                    splits are views of a single PolicyDataset
+    :param n_items: int, only use the first n_items of data (eg. to train on the
+                    first L BusyBoxes of a dataset that is only tensorized once)
+    :param share_images: bool, see create_loader
+    """
+    kwargs = {'num_workers': num_workers,
+              'pin_memory': use_cuda,
+              'seed': seed,
+              'num_replicas': num_replicas,
+              'rank': rank,
+              'share_images': share_images}
+
+    full_set = data if isinstance(data, PolicyDataset) else PolicyDataset(data)
+    ixs = list(range(len(full_set) if n_items is None else n_items))
 
     if single_set:
-        set = PolicyDataset(data)
-        loader = torch.utils.data.DataLoader(dataset=set,
-                                                   batch_sampler=CustomSampler(set.items, batch_size),
-                                                   **kwargs)
+        set = PolicySubset(full_set, ixs)
+        loader = create_loader(set, batch_size, **kwargs)
         return loader
     else:
         # Create datasplits.
-        train_data, val_data, test_data = create_data_splits(data, val_pct=.2)
-        random.Random(0).shuffle(train_data)
-        random.Random(0).shuffle(val_data)
-        random.Random(0).shuffle(test_data)
+        train_ixs, val_ixs, test_ixs = create_data_splits(ixs, val_pct=.2)
+        random.Random(0).shuffle(train_ixs)
+        random.Random(0).shuffle(val_ixs)
+        random.Random(0).shuffle(test_ixs)
         #if small_train > 0:
-        #    train_data = train_data[:small_train]
-
-        # TODO: Populate dataset objects
-
-        train_set = PolicyDataset(train_data)
-        val_set = PolicyDataset(val_data)
-        test_set = PolicyDataset(test_data)
-
-        train_loader = torch.utils.data.DataLoader(dataset=train_set,
-                                                   batch_sampler=CustomSampler(train_set.items, batch_size),
-                                                   **kwargs)
-        val_loader = torch.utils.data.DataLoader(dataset=val_set,
-                                                 batch_sampler=CustomSampler(val_set.items, batch_size),
-                                                 **kwargs)
-        test_loader = torch.utils.data.DataLoader(dataset=test_set,
-                                                  batch_sampler=CustomSampler(test_set.items, batch_size),
-                                                  **kwargs)
+        #    train_ixs = train_ixs[:small_train]
+
+        train_set = PolicySubset(full_set, train_ixs)
+        val_set = PolicySubset(full_set, val_ixs)
+        test_set = PolicySubset(full_set, test_ixs)
+
+        train_loader = create_loader(train_set, batch_size, **kwargs)
+        val_loader = create_loader(val_set, batch_size, **kwargs)
+        test_loader = create_loader(test_set, batch_size, **kwargs)
         return train_loader, val_loader, test_loader
 
 
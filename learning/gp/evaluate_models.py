@@ -9,11 +9,18 @@ from gen.generate_policy_data import get_bb_dataset
 
 SUCCESS_REGRET = 0.05
 
-def get_models(L, models_path):
+def get_models(L, models_path, hdim=None):
+    """
+    :param hdim: int, if given models tagged with a different hdim (eg. by
+                    learning.train_parallel) are skipped, untagged models are kept
+    """
     all_files = os.walk(models_path)
     models = []
     for root, subdir, files in all_files:
         for file in files:
+            file_hdim = re.search(r'_(\d+)hdim', file)
+            if hdim is not None and file_hdim is not None and int(file_hdim.group(1)) != hdim:
+                continue
             if (file[-3:] == '.pt') and ('_'+str(L)+'L_' in file):
                 full_path = root+'/'+file
                 models.append(full_path)
@@ -28,7 +35,7 @@ def evaluate_models(n_bbs, args, use_cuda=False):
 
     all_results = {}
     for L in range(args.Ls[0], args.Ls[1]+1, args.Ls[2]):
-        models = get_models(L, args.models_path)
+        models = get_models(L, args.models_path, args.hdim)
         all_L_results = {}
         for model in models:
             all_model_test_steps = []
@@ -79,7 +86,7 @@ if __name__ == '__main__':
     parser.add_argument(
         '--urdf-num',
         default=0,
-        help='number to append to generated urdf files. Use if generating multiple datasets simultaneously.')
+        help='unused, urdf files are now cached by busybox contents (kept for old scripts)')
     parser.add_argument(
         '--bb-fname',
         default='',
@@ -106,6 +113,15 @@ if __name__ == '__main__':
         type=int,
         help='min max step of Ls')
     parser.add_argument('--mech-types', nargs='+', default=['slider'], type=str)
+    parser.add_argument(
+        '--batch-optim',
+        action='store_true',
+        help='optimize the GP-UCB starts together instead of one at a time')
+    parser.add_argument(
+        '--gp-refit-every',
+        type=int,
+        default=10,
+        help='number of interactions between optimizing the GP kernel noise (0 to never optimize it)')
     args = parser.parse_args()
 
     if args.debug:
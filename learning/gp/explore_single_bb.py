@@ -1,10 +1,8 @@
-from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.gaussian_process.kernels import RBF, WhiteKernel, ConstantKernel
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import cm
 from mpl_toolkits.mplot3d import Axes3D
-import torch.nn.functional as F
 from collections import OrderedDict
 import pickle
 import os
@@ -12,17 +10,19 @@ import sys
 import argparse
 from argparse import Namespace
 from scipy.optimize import minimize
+from scipy.linalg import cho_solve
 import itertools
 from utils import util
 from utils.setup_pybullet import setup_env
 from gen.generator_busybox import BusyBox
-import operator
 import torch
-from learning.dataloaders import PolicyDataset, parse_pickle_file
+from learning.dataloaders import get_image_tensor
 from gen.generate_policy_data import get_bb_dataset
-from actions.policies import Policy, generate_policy, Revolute, Prismatic, \
-                                    get_policy_from_tuple, get_policy_from_x
+from actions.policies import Policy, PolicyParams, generate_policy, Revolute, Prismatic, \
+                                    get_policy_from_tuple, get_policy_from_x, \
+                                    get_matched_policy_type
 from learning.gp.viz_polar_plots import viz_circles
+from learning.gp.incremental_gp import IncrementalGP
 import time
 
 BETA = 2
@@ -57,31 +57,135 @@ def process_data(data, n_train):
     return X, Y
 
 
-def get_nn_preds(results, model, ret_dataset=False, use_cuda=False):
-    data = parse_pickle_file(results)
-    dataset = PolicyDataset(data)
-    pred_motions = []
-    for i in range(len(dataset.items)):
-        policy_type = dataset.items[i]['type']
-        policy_type_tensor = torch.Tensor([util.name_lookup[policy_type]])
-        policy_tensor = dataset.tensors[i].unsqueeze(0)
-        image_tensor = dataset.images[i].unsqueeze(0)
-        if use_cuda:
-            policy_type_tensor = policy_type_tensor.cuda()
-            policy_tensor = policy_tensor.cuda()
-            image_tensor = image_tensor.cuda()
-        pred_motion, _ = model.forward(policy_type_tensor,
-                                       policy_tensor,
-                                       image_tensor)
-        if use_cuda:
-            pred_motion_float = pred_motion.cpu().detach().numpy()[0][0]
+def gp_predict_with_grad(gp, X):
+    """
+    The GP posterior mean and std and their gradients. Only for the
+    ConstantKernel * RBF + WhiteKernel kernels of UCB_Interaction.get_kernel.
+    :param gp: GaussianProcessRegressor or IncrementalGP of a single target, fit or not
+    :param X: np.array (N, d)
+    :return: mean (N,), std (N,), mean gradients (N, d), std gradients (N, d)
+    """
+    X = np.asarray(X, dtype=np.float64)
+    if not hasattr(gp, 'X_train_'):
+        # unfit GPs predict with the prior: zero mean and constant std
+        std = np.sqrt(gp.kernel.diag(X))
+        return np.zeros(len(X)), std, np.zeros(X.shape), np.zeros(X.shape)
+
+    y_train_mean = float(np.squeeze(getattr(gp, '_y_train_mean', 0.0)))
+    y_train_std = float(np.squeeze(getattr(gp, '_y_train_std', 1.0)))
+    length_scale = np.asarray(gp.kernel_.k1.k2.length_scale)
+    # the WhiteKernel doesn't contribute to the covariance with the training points
+    K = gp.kernel_(X, gp.X_train_)
+    dK = -K[:, :, np.newaxis] * (X[:, np.newaxis, :] - gp.X_train_) / length_scale**2
+    alpha = np.reshape(gp.alpha_, K.shape[1])
+    mean = K.dot(alpha) * y_train_std + y_train_mean
+    dmean = np.einsum('j,ijk->ik', alpha, dK) * y_train_std
+
+    # var = k(x, x) - k^T K^-1 k so dvar = -2 (K^-1 k)^T dk
+    K_inv_k = cho_solve((gp.L_, True), K.T).T
+    var = (gp.kernel_.diag(X) - np.sum(K * K_inv_k, axis=1)) * y_train_std**2
+    positive = var > 0
+    std = np.sqrt(np.where(positive, var, 0.0))
+    dstd = -np.einsum('ij,ijk->ik', K_inv_k, dK) * y_train_std**2
+    dstd = np.where(positive[:, np.newaxis], dstd / np.where(positive, std, 1.0)[:, np.newaxis], 0.0)
+    return mean, std, dmean, dstd
+
+
+def minimize_batch(fun, X0, bounds, maxiter=1000, gtol=1e-8, ftol=2.2e-9, maxls=50, maxcor=10):
+    """
+    Minimize from many starting points at once with a projected L-BFGS method (the
+    L-BFGS direction of the variables not held at a bound, projected back onto the
+    bounds with a backtracking line search). Each iteration evaluates fun once on
+    the current points of all of the unconverged starts, each start stops on its
+    own. The tolerances are the same as scipy's L-BFGS-B, but the steps (and so
+    which local optimum a start ends at) can differ from it.
+    :param fun: function from X (N, d) to the objective values (N,) and gradients (N, d)
+    :param X0: np.array (N, d), the starting points
+    :param bounds: list of d (min, max) bounds
+    :param maxiter: int, max iterations of each start
+    :param gtol: float, a start stops when its projected gradient is smaller than this
+    :param ftol: float, or when its relative decrease in the objective is smaller than this
+    :param maxls: int, or when its line search fails after maxls step halvings
+    :param maxcor: int, number of updates stored for the L-BFGS direction
+    :return: the final points (N, d) and their objective values (N,)
+    """
+    lo, hi = np.array(bounds, dtype=np.float64).T
+    X = np.clip(np.asarray(X0, dtype=np.float64), lo, hi)
+    n, d = X.shape
+    f, g = fun(X)
+    # the last maxcor updates of each start, newest last (unused updates have rho 0)
+    S, Y, rho = np.zeros((n, maxcor, d)), np.zeros((n, maxcor, d)), np.zeros((n, maxcor))
+    # step size of the steepest descent steps taken without curvature information,
+    # the first step moves at most 1 in any dimension (as L-BFGS-B)
+    step = 1/np.maximum(np.max(np.abs(g), axis=1), 1.0)
+    active = np.ones(n, dtype=bool)
+    for it in range(maxiter):
+        active &= np.max(np.abs(X - np.clip(X - g, lo, hi)), axis=1) > gtol
+        ixs = np.flatnonzero(active)
+        if len(ixs) == 0:
+            break
+
+        # L-BFGS two loop recursion on the variables that aren't held at a bound
+        x, gx = X[ixs], g[ixs]
+        free = ~(((x <= lo) & (gx > 0)) | ((x >= hi) & (gx < 0)))
+        q = gx*free
+        alpha = np.zeros((len(ixs), maxcor))
+        for j in reversed(range(maxcor)):
+            alpha[:, j] = rho[ixs, j] * np.sum(S[ixs, j]*q, axis=1)
+            q -= alpha[:, j, np.newaxis]*Y[ixs, j]
+        yy = np.sum(Y[ixs, -1]**2, axis=1)
+        gamma = np.where(rho[ixs, -1] > 0, 1/np.maximum(rho[ixs, -1]*yy, 1e-300), 1.0)
+        r = gamma[:, np.newaxis]*q
+        for j in range(maxcor):
+            beta = rho[ixs, j] * np.sum(Y[ixs, j]*r, axis=1)
+            r += S[ixs, j]*(alpha[:, j] - beta)[:, np.newaxis]
+        D = -r*free
+        # restart from steepest descent where the direction isn't a descent direction
+        restart = np.sum(D*gx, axis=1) >= 0
+        D[restart] = -(gx*free)[restart]
+        rho[ixs[restart]] = 0
+        quasi_newton = rho[ixs, -1] > 0
+        t = np.where(quasi_newton, 1.0, step[ixs])
+
+        # backtrack until the projected step sufficiently decreases the objective
+        X_new, f_new, g_new = np.empty(x.shape), np.empty(len(ixs)), np.empty(x.shape)
+        trying = np.arange(len(ixs))
+        for _ in range(maxls):
+            X_try = np.clip(x[trying] + t[trying, np.newaxis]*D[trying], lo, hi)
+            f_try, g_try = fun(X_try)
+            X_new[trying], f_new[trying], g_new[trying] = X_try, f_try, g_try
+            decrease = np.sum(gx[trying]*(X_try - x[trying]), axis=1)
+            failed = f_try > f[ixs[trying]] + 1e-4*decrease
+            if not np.any(failed):
+                break
+            trying = trying[failed]
+            t[trying] /= 2
         else:
-            pred_motion_float = pred_motion.detach().numpy()[0][0]
-        pred_motions += [pred_motion_float]
-    if ret_dataset:
-        return pred_motions, dataset
-    else:
-        return pred_motions
+            # the line search failed, stop at the current point
+            active[ixs[trying]] = False
+            keep = np.ones(len(ixs), dtype=bool)
+            keep[trying] = False
+            ixs, x, gx = ixs[keep], x[keep], gx[keep]
+            X_new, f_new, g_new = X_new[keep], f_new[keep], g_new[keep]
+            t, gamma, quasi_newton = t[keep], gamma[keep], quasi_newton[keep]
+        # without curvature (eg. where the objective is linear) grow the steps
+        step[ixs] = np.where(quasi_newton, gamma, 2*t)
+
+        # store the update if it keeps the approximate Hessian positive definite
+        s, y = X_new - x, g_new - gx
+        sy = np.sum(s*y, axis=1)
+        keep = sy > 1e-10*np.maximum(np.sum(y*y, axis=1), 1e-300)
+        update = ixs[keep]
+        S[update], Y[update], rho[update] = np.roll(S[update], -1, axis=1), \
+                                            np.roll(Y[update], -1, axis=1), \
+                                            np.roll(rho[update], -1, axis=1)
+        S[update, -1], Y[update, -1], rho[update, -1] = s[keep], y[keep], 1/sy[keep]
+
+        converged = (f[ixs] - f_new) <= ftol*np.maximum(np.maximum(np.abs(f[ixs]), np.abs(f_new)), 1.0)
+        X[ixs], f[ixs], g[ixs] = X_new, f_new, g_new
+        active[ixs[converged]] = False
+    return X, f
+
 
 def test_model(sampler, args, gripper=None):
     """
@@ -97,7 +201,7 @@ def test_model(sampler, args, gripper=None):
     debug = False
     viz = False
     if gripper is None:
-        _, gripper = setup_env(sampler.bb, viz, debug)
+        _, gripper = setup_env(sampler.bb, viz, debug, render=False)
     else:
         gripper.reset(sampler.mech)
     pose_handle_base_world = sampler.mech.get_pose_handle_base_world()
@@ -113,89 +217,89 @@ def test_model(sampler, args, gripper=None):
 
 class GPOptimizer(object):
 
-    def __init__(self, urdf_num, bb, image_data, n_samples, beta, gps, nn=None):
+    def __init__(self, urdf_num, bb, image_data, n_samples, beta, gps, nn=None,
+                    batch_optim=False):
         """
         Initialize one of these for each BusyBox.
+        :param batch_optim: if True optimize all of the starts of optimize_gp together
+                            (see minimize_batch), else one at a time with L-BFGS-B
         """
-        self.sample_policies = []
-        self.nn_samples = []
         self.nn = nn
+        self.batch_optim = batch_optim
         self.mech = bb._mechanisms[0]
         self.beta = beta
         self.gps = gps
         self.n_samples = n_samples
-        self.saved_im = None
-
-        # Generate random policies.
-        for _ in range(n_samples):
-            random_policy = generate_policy(self.mech)
-            policy_type = random_policy.type
-            policy_tuple = random_policy.get_policy_tuple()
-
-            results = [util.Result(policy_tuple, None, 0.0, None, None, None, \
-                                    image_data, None)]
-            self.sample_policies.append(results)
-
+        # the image is encoded once and reused for every NN prediction
+        self.image_emb = None
+        if self.nn is not None:
+            self.image_emb = self.nn.encode_image(get_image_tensor(image_data))
+
+        # Generate random policies, an (n_samples, d) array of xs for each policy type
+        # (only the policy type matching the mechanism, as in generate_policy)
+        self.sample_xs, self.nn_samples = OrderedDict(), OrderedDict()
+        for policy_type in [get_matched_policy_type(self.mech)]:
+            self.sample_xs[policy_type] = Policy.sample_x(policy_type, n_samples)
             if self.nn is not None:
-                nn_preds, self.dataset = get_nn_preds(results, nn, ret_dataset=True, use_cuda=False)
-                self.nn_samples.append(nn_preds)
+                self.nn_samples[policy_type] = self.get_nn_pred(policy_type,
+                                                    self.sample_xs[policy_type])
             else:
-                self.dataset = None
-                self.nn_samples.append(None)
+                self.nn_samples[policy_type] = None
         # print('Max:', np.max(self.nn_samples))
 
         self.log = []
 
-    def _optim_result_to_torch(self, policy_type, x, image_tensor, use_cuda=False):
-        policy_type_tensor = torch.Tensor([util.name_lookup[policy_type]])
-        policy_tensor = torch.tensor(x).float().unsqueeze(0)
-        if use_cuda:
-            policy_type_tensor = policy_type_tensor.cuda()
-            policy_tensor = policy_tensor.cuda()
-            image_tensor = image_tensor.cuda()
-
-        return [policy_type_tensor, policy_tensor, image_tensor]
+    def get_nn_pred(self, policy_type, X):
+        """
+        :param X: np.array (N, d), policy params of policy_type
+        :return: np.array (N,), the NN predictions on this BusyBox
+        """
+        return self.nn.predict_from_embedding(policy_type, X, self.image_emb).cpu().numpy()[:, 0]
 
-    def _objective_func(self, x, policy_type, ucb, image_tensor=None):
-        X = np.expand_dims(x, axis=0)
+    def _objective_func(self, x, policy_type, ucb):
+        """
+        :return: the objective (negative GP (+ NN) mean or UCB) at x and its gradient
+        """
+        obj, grad = self._batch_objective_func(np.expand_dims(x, axis=0), policy_type, ucb)
+        return obj[0], grad[0]
 
-        Y_pred, Y_std = self.gps[policy_type].predict(X, return_std=True)
+    def _batch_objective_func(self, X, policy_type, ucb):
+        """
+        :param X: np.array (N, d), policy params of policy_type
+        :return: the objectives (N,) and their gradients (N, d)
+        """
+        Y_pred, Y_std, dY_pred, dY_std = gp_predict_with_grad(self.gps[policy_type], X)
 
         if not self.nn is None:
-            inputs = self._optim_result_to_torch(policy_type, x, image_tensor, False)
-            nn_x = self.nn.policy_modules[policy_type].forward(inputs[1])
-            if self.saved_im is None:
-                self.saved_im, _ = self.nn.image_module(inputs[2])
-            nn_x = torch.cat([nn_x, self.saved_im], dim=1)
-            nn_x = F.relu(self.nn.fc1(nn_x))
-            nn_x = F.relu(self.nn.fc2(nn_x))
-            val = self.nn.fc5(nn_x)
-
-            # val, _ = self.nn.forward(*inputs)
-            val = val.detach().numpy()
-            Y_pred += val.squeeze()
+            nn_pred, nn_grad = self.nn.grad_from_embedding(policy_type, X, self.image_emb)
+            Y_pred = Y_pred + nn_pred.cpu().numpy()[:, 0]
+            dY_pred = dY_pred + nn_grad.cpu().numpy()
 
         if ucb:
-            obj = -Y_pred[0] - np.sqrt(self.beta) * Y_std[0]
+            obj = -Y_pred - np.sqrt(self.beta) * Y_std
+            grad = -dY_pred - np.sqrt(self.beta) * dY_std
         else:
-            obj = -Y_pred[0]
-        return obj
+            obj = -Y_pred
+            grad = -dY_pred
+        return obj, grad
 
-    def _get_pred_motions(self, data, ucb, nn_preds=None):
-        X, Y = process_data(data, len(data))
-        y_pred, y_std = np.zeros(len(data)), np.zeros(len(data))
-        for i, res in enumerate(data):
-            y_pred_res, y_std_res = self.gps[res.policy_params.type].predict(X, return_std=True)
-            y_pred[i] = y_pred_res
-            y_std[i] = y_std_res
+    def _get_pred_motions(self, policy_type, X, ucb, nn_preds=None):
+        """
+        :param X: np.array (N, d), policy params of policy_type
+        :param nn_preds: np.array (N,), NN predictions of X (see get_nn_pred)
+        :return: np.array (N,), the predicted motions (or UCB) of X
+        """
+        y_pred, y_std = self.gps[policy_type].predict(X, return_std=True)
+        # old versions of sklearn predict (N, 1) means of GPs fit on (n, 1) ys
+        y_pred, y_std = np.reshape(y_pred, len(X)), np.reshape(y_std, len(X))
 
         if not nn_preds is None:
-            y_pred += np.array(nn_preds)
+            y_pred += nn_preds
 
         if ucb:
-            return y_pred + np.sqrt(self.beta) * y_std, self.dataset
+            return y_pred + np.sqrt(self.beta) * y_std
         else:
-            return y_pred, self.dataset
+            return y_pred
 
     def optimize_gp(self, ucb):
         """
@@ -203,38 +307,43 @@ class GPOptimizer(object):
         :param ucb: If True use the GP-UCB criterion
         :return: x_final, the optimal policy according to the current model.
         """
-        samples = []
-
-        # Generate random policies.
-        for res, nn_preds in zip(self.sample_policies, self.nn_samples):
-            # Get predictions from the GP.
-            sample_disps, dataset = self._get_pred_motions(res, ucb, nn_preds=nn_preds)
-
-            samples.append((res[0].policy_params, sample_disps[0]))
-
-        # Find the sample that maximizes the distance.
-        policies = sorted(samples, key=operator.itemgetter(1))
+        # Get predictions from the GP of the random policies, one call per policy type.
+        policy_types = list(self.sample_xs.keys())
+        sample_disps = np.concatenate([self._get_pred_motions(policy_type,
+                                            self.sample_xs[policy_type], ucb,
+                                            nn_preds=self.nn_samples[policy_type])
+                                        for policy_type in policy_types])
+        n_samples = [len(self.sample_xs[policy_type]) for policy_type in policy_types]
+        type_ixs = np.repeat(np.arange(len(policy_types)), n_samples)
+        row_ixs = np.concatenate([np.arange(n) for n in n_samples])
+
+        # Find the samples that maximize the distance (in increasing order).
+        n_starts = min(10, len(sample_disps))
+        max_ixs = np.argpartition(sample_disps, len(sample_disps)-n_starts)[len(sample_disps)-n_starts:]
+        max_ixs = max_ixs[np.argsort(sample_disps[max_ixs])]
 
         # Start optimization from here.
-        if self.nn is None:
-            images = None
+        starts = [(policy_types[type_ixs[ix]], self.sample_xs[policy_types[type_ixs[ix]]][row_ixs[ix]])
+                    for ix in max_ixs]
+        if self.batch_optim:
+            opt_xs, opt_vals = self._optimize_batch(starts, ucb)
         else:
-            images = dataset.images[0].unsqueeze(0)
+            opt_xs, opt_vals = [], []
+            for policy_type, x0 in starts:
+                opt_res = minimize(fun=self._objective_func, x0=x0,
+                                    args=(policy_type, ucb), jac=True,
+                                    method='L-BFGS-B', options={'maxiter': 1000,
+                                                                'gtol': 1e-8,
+                                                                'maxls': 50,
+                                                                }, bounds=Policy.get_bounds(policy_type))
+                opt_xs.append(opt_res['x'])
+                opt_vals.append(opt_res['fun'])
 
         min_val, stop_policy, x_final = float("inf"), None, None
-        for policy_params_max, max_disp in policies[-10:]:
-            x0, bounds = get_x_and_bounds_from_tuple(policy_params_max)
-            opt_res = minimize(fun=self._objective_func, x0=x0,
-                                args=(policy_params_max.type, ucb, images),
-                                method='L-BFGS-B', options={'eps': 1e-3,
-                                                            'maxiter': 1000,
-                                                            'gtol': 1e-8,
-                                                            'maxls': 50,
-                                                            }, bounds=bounds)
-
-            val = opt_res['fun']
+        for (policy_type, x0), x, val in zip(starts, opt_xs, opt_vals):
             if val <= min_val:
-                x_final = opt_res['x']
+                x_final = x
+                policy_params_max = PolicyParams(policy_type, None, Policy.get_param_data(policy_type))
                 stop_policy = get_policy_from_x(self.mech, x_final, policy_params_max)
                 min_val = val
         # print(opt_res)
@@ -246,6 +355,26 @@ class GPOptimizer(object):
         # print('------')
         return x_final, stop_policy, x0
 
+    def _optimize_batch(self, starts, ucb):
+        """
+        Optimize all of the starts of each policy type together (see minimize_batch)
+        :param starts: list of (policy_type, x0) tuples
+        :return: list of the optimized xs and list of their objective values (in
+                    the order of starts)
+        """
+        opt_xs, opt_vals = [None]*len(starts), [None]*len(starts)
+        for policy_type in set(policy_type for policy_type, _ in starts):
+            ixs = [i for i, (start_type, _) in enumerate(starts) if start_type == policy_type]
+            X, vals = minimize_batch(lambda X: self._batch_objective_func(X, policy_type, ucb),
+                                     np.array([starts[i][1] for i in ixs]),
+                                     Policy.get_bounds(policy_type),
+                                     maxiter=1000,
+                                     gtol=1e-8,
+                                     maxls=50)
+            for i, x, val in zip(ixs, X, vals):
+                opt_xs[i], opt_vals[i] = x, val
+        return opt_xs, opt_vals
+
 
 class UCB_Interaction(object):
 
@@ -265,12 +394,15 @@ class UCB_Interaction(object):
         self.bb = bb
         self.image_data = image_data
         self.mech = self.bb._mechanisms[0]
-        self.gps = {'Prismatic': GaussianProcessRegressor(kernel=self.get_kernel('Prismatic'), #args.type),
-                                               n_restarts_optimizer=1),
-                    'Revolute': GaussianProcessRegressor(kernel=self.get_kernel('Revolute'), #args.type),
-                                                       n_restarts_optimizer=1)}
+        # the GPs are updated incrementally after each interaction and their kernel
+        # hyperparameters (the noise) are only refit every args.gp_refit_every interactions
+        self.gps = {'Prismatic': IncrementalGP(kernel=self.get_kernel('Prismatic'), #args.type),
+                                               refit_every=args.gp_refit_every),
+                    'Revolute': IncrementalGP(kernel=self.get_kernel('Revolute'), #args.type),
+                                              refit_every=args.gp_refit_every)}
         self.optim = GPOptimizer(args.urdf_num, self.bb, self.image_data, \
-                        args.n_gp_samples, BETA, self.gps, nn=self.nn)
+                        args.n_gp_samples, BETA, self.gps, nn=self.nn,
+                        batch_optim=args.batch_optim)
 
     def get_kernel(self, type):#, explore_type):
         noise = 1e-5
@@ -335,16 +467,11 @@ class UCB_Interaction(object):
         if self.nn is None:
             self.ys[policy_type].append([result.net_motion])
         else:
-            inputs = self.optim._optim_result_to_torch(policy_type,
-                                                       self.xs[policy_type][-1],
-                                                       self.optim.dataset.images[0].unsqueeze(0),
-                                                       use_cuda=False)
-            nn_pred = self.nn.forward(*inputs)[0]
-            nn_pred = nn_pred.detach().numpy().squeeze()
+            nn_pred = self.optim.get_nn_pred(policy_type, np.expand_dims(x, axis=0))[0]
             self.ys[policy_type].append([result.net_motion - nn_pred])
 
         self.moves[policy_type].append([result.net_motion])
-        self.gps[policy_type].fit(np.array(self.xs[policy_type]), np.array(self.ys[policy_type]))
+        self.gps[policy_type].add(x, self.ys[policy_type][-1])
 
     def calc_avg_regret(self):
         regrets = []
@@ -407,22 +534,23 @@ def create_gpucb_dataset(n_interactions, n_bbs, args):
     :param args:
     :return:
     """
-    busybox_data = get_bb_dataset(args.bb_fname, n_bbs, args.mech_types, 1, args.urdf_num)
-
-    '''
-    # Do a GP-UCB interaction and return Result tuples.
-    if os.path.exists(args.fname):
-        with open(args.fname, 'rb') as handle:
-            dataset = pickle.load(handle)
-        n_collected = len(dataset)//n_interactions
-        busybox_data = busybox_data[n_collected:]
-        print('Already Collected: %d\tRemaining: %d' % (n_collected, len(busybox_data)))
-    else:
-        dataset = []
-    '''
-    dataset = []
+    bbs_fname = args.fname + '.bbs' if args.fname != '' else None
+    busybox_data = get_bb_dataset(args.bb_fname, n_bbs, args.mech_types, 1, args.urdf_num,
+                                    bbs_fname=bbs_fname)
+
+    # Stream each BusyBox's Result tuples to file as soon as they are collected and
+    # skip the BusyBoxes already in the file when resuming.
+    writer = None
+    if args.fname != '':
+        writer = util.ResultStreamWriter(args.fname)
+        if len(writer.committed) > 0:
+            print('Already Collected: %d\tRemaining: %d' % (len(writer.committed),
+                    len(busybox_data)-len(writer.committed)))
+
     #regrets = []
     for ix, bb_results in enumerate(busybox_data):
+        if writer is not None and ix in writer.committed:
+            continue
         single_dataset, _ = create_single_bb_gpucb_dataset(bb_results[0],
                                                               '',
                                                               args.plot,
@@ -430,15 +558,15 @@ def create_gpucb_dataset(n_interactions, n_bbs, args):
                                                               ix,
                                                               n_interactions=n_interactions,
                                                               plot_dir_prefix=args.plot_dir)
-        dataset.append(single_dataset)
+        if writer is not None:
+            writer.write(ix, single_dataset)
         #regrets.append(r)
         print('Interacted with BusyBox %d.' % ix)
         #print('Regret:', np.mean(regrets))
 
-    # Save the dataset.
-    
-    if args.fname != '':
-        util.write_to_file(args.fname, dataset)
+    if writer is not None:
+        writer.close()
+        print('wrote file to '+args.fname)
 
 def create_single_bb_gpucb_dataset(bb_result, nn_fname, plot, args, bb_i,
                                    n_interactions=None, plot_dir_prefix='',
@@ -455,7 +583,6 @@ def create_single_bb_gpucb_dataset(bb_result, nn_fname, plot, args, bb_i,
     pose_handle_base_world = mech.get_pose_handle_base_world()
     sampler = UCB_Interaction(bb, image_data, plot, args, nn_fname=nn_fname)
     for ix in itertools.count():
-        gripper.reset(mech)
         if args.debug:
             sys.stdout.write('\rProcessing sample %i' % ix)
         # if we are done sampling n_interactions OR we need to get regret after
@@ -464,7 +591,6 @@ def create_single_bb_gpucb_dataset(bb_result, nn_fname, plot, args, bb_i,
             (not success_regret is None):
 
             regret, start_x, stop_x, policy_type = test_model(sampler, args, gripper=gripper)
-            gripper.reset(mech)
 
             #print('Current regret', regret)
             opt_points = (policy_type, [(start_x, 'g'), (stop_x, 'r')])
@@ -514,6 +640,7 @@ def create_single_bb_gpucb_dataset(bb_result, nn_fname, plot, args, bb_i,
         # sample a policy
         # image_data, gripper = setup_env(bb, False, debug)
 
+        # restores the snapshot taken in setup_env so every trial starts identically
         gripper.reset(mech)
         x, policy = sampler.sample()
 
@@ -604,7 +731,7 @@ if __name__ == '__main__':
     parser.add_argument(
         '--urdf-num',
         default=0,
-        help='number to append to generated urdf files. Use if generating multiple datasets simultaneously.')
+        help='unused, urdf files are now cached by busybox contents (kept for old scripts)')
     parser.add_argument(
         '--bb-fname',
         default='',
@@ -626,11 +753,20 @@ if __name__ == '__main__':
     parser.add_argument(
         '--fname',
         default='',
-        help='path to save resulting dataset to')
+        help='path to save resulting dataset to (appended to as each BusyBox is done, rerun to resume)')
     parser.add_argument(
         '--nn-fname',
         default='',
         help='path to save resulting dataset to')
+    parser.add_argument(
+        '--batch-optim',
+        action='store_true',
+        help='optimize the GP-UCB starts together instead of one at a time')
+    parser.add_argument(
+        '--gp-refit-every',
+        type=int,
+        default=10,
+        help='number of interactions between optimizing the GP kernel noise (0 to never optimize it)')
     parser.add_argument(
         '--debug',
         action='store_true',
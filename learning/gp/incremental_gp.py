@@ -0,0 +1,126 @@
+""" A GP regressor that adds observations with a bordered Cholesky update in O(n^2)
+instead of refitting in O(n^3). The kernel hyperparameters (eg. the WhiteKernel
+noise) are only optimized every refit_every observations. It has the attributes
+of a fit sklearn GaussianProcessRegressor (X_train_, y_train_, alpha_, L_,
+kernel_, _y_train_mean, _y_train_std) so it can be used anywhere one is, eg. in
+explore_single_bb.gp_predict_with_grad.
+"""
+import numpy as np
+from scipy.linalg import cholesky, cho_solve, solve_triangular
+from sklearn.gaussian_process import GaussianProcessRegressor
+
+
+class IncrementalGP(object):
+    def __init__(self, kernel, alpha=1e-10, refit_every=1, n_restarts_optimizer=1):
+        """
+        :param kernel: sklearn kernel, the initial hyperparameters
+        :param alpha: float, added to the diagonal of the training covariance (as the
+                        alpha of GaussianProcessRegressor)
+        :param refit_every: int, the hyperparameters are optimized (with a
+                        GaussianProcessRegressor) after each of the first refit_every
+                        observations and then after every refit_every observations,
+                        the observations in between are added with the last
+                        hyperparameters. 1 is the same as refitting a
+                        GaussianProcessRegressor after each observation, 0 never
+                        optimizes them
+        :param n_restarts_optimizer: int, of the GaussianProcessRegressor refits
+        """
+        self.kernel = kernel
+        self.kernel_ = kernel
+        self.alpha = alpha
+        self.refit_every = refit_every
+        self.n_restarts_optimizer = n_restarts_optimizer
+
+    def fit(self, X, y):
+        """ Fit on all of the observations from scratch with the current hyperparameters
+        :param X: np.array (n, d)
+        :param y: np.array (n,) or (n, 1)
+        """
+        self._set_train(X, y)
+        K = self.kernel_(self.X_train_)
+        K[np.diag_indices_from(K)] += self.alpha
+        self.L_ = cholesky(K, lower=True)
+        self.alpha_ = cho_solve((self.L_, True), self.y_train_)
+        return self
+
+    def _set_train(self, X, y):
+        self.X_train_ = np.array(X, dtype=np.float64)
+        self.y_train_ = np.array(y, dtype=np.float64)
+        # the targets aren't normalized (as normalize_y=False)
+        self._y_train_mean = np.zeros(self.y_train_.shape[1:])
+        self._y_train_std = np.ones(self.y_train_.shape[1:])
+
+    def add(self, x, y):
+        """ Add a single observation. The Cholesky factor of the training covariance
+        is extended with a new row instead of being recomputed.
+        :param x: np.array (d,)
+        :param y: float or np.array (1,), in the same shape as the ys passed to fit
+        """
+        x = np.array(x, dtype=np.float64).reshape(1, -1)
+        if not hasattr(self, 'X_train_'):
+            if self.refit_every > 0:
+                return self.refit(x, [y])
+            return self.fit(x, [y])
+        n = len(self.X_train_)
+        # the noise estimate changes the most while there are few observations (and
+        # refitting then is cheap)
+        if self.refit_every > 0 and (n < self.refit_every or n % self.refit_every == 0):
+            return self.refit(np.concatenate([self.X_train_, x]),
+                              np.concatenate([self.y_train_, np.array([y], dtype=np.float64)]))
+
+        # [[L, 0], [l^T, d]] is the Cholesky factor of [[K, k], [k^T, c]]
+        k = self.kernel_(self.X_train_, x)[:, 0]
+        c = self.kernel_.diag(x)[0] + self.alpha
+        l = solve_triangular(self.L_, k, lower=True)
+        d2 = c - l.dot(l)
+        X_train = np.concatenate([self.X_train_, x])
+        y_train = np.concatenate([self.y_train_, np.array([y], dtype=np.float64)])
+        if d2 <= 0:
+            # numerically not positive definite, refit to raise the same error as sklearn
+            return self.fit(X_train, y_train)
+
+        L = np.zeros((n+1, n+1))
+        L[:n, :n] = self.L_
+        L[n, :n] = l
+        L[n, n] = np.sqrt(d2)
+        self.X_train_, self.y_train_, self.L_ = X_train, y_train, L
+        self.alpha_ = cho_solve((self.L_, True), self.y_train_)
+        return self
+
+    def refit(self, X, y):
+        """ Optimize the hyperparameters on all of the observations and fit with them
+        """
+        gp = GaussianProcessRegressor(kernel=self.kernel, alpha=self.alpha,
+                                      n_restarts_optimizer=self.n_restarts_optimizer)
+        gp.fit(X, y)
+        self._set_train(X, y)
+        # the regressor already factorized the training covariance with the new kernel
+        self.kernel_, self.L_, self.alpha_ = gp.kernel_, gp.L_, gp.alpha_
+        return self
+
+    def predict(self, X, return_std=False):
+        """
+        :param X: np.array (N, d)
+        :param return_std: bool, also return the std of the predictions
+        :return: the mean (N,) and if return_std the std (N,) of the posterior at X,
+                    the prior if not fit yet (as GaussianProcessRegressor of a
+                    single target)
+        """
+        X = np.asarray(X, dtype=np.float64)
+        if not hasattr(self, 'X_train_'):
+            y_mean = np.zeros(len(X))
+            if return_std:
+                return y_mean, np.sqrt(self.kernel.diag(X))
+            return y_mean
+
+        K_trans = self.kernel_(X, self.X_train_)
+        y_mean = K_trans.dot(self.alpha_)
+        if y_mean.ndim == 2 and y_mean.shape[1] == 1:
+            y_mean = y_mean[:, 0]
+        if not return_std:
+            return y_mean
+        v = solve_triangular(self.L_, K_trans.T, lower=True)
+        y_var = self.kernel_.diag(X) - np.sum(v**2, axis=0)
+        # as sklearn, negative variances are numerical errors
+        y_var[y_var < 0] = 0.0
+        return y_mean, np.sqrt(y_var)
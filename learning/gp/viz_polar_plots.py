@@ -1,15 +1,14 @@
 import numpy as np
 import matplotlib.pyplot as plt
-import torch
 import os
 import itertools
 from functools import reduce
 from actions.policies import Policy, PolicyParams
 from utils import util
-from learning.dataloaders import PolicyDataset, parse_pickle_file
+from learning.dataloaders import get_image_tensor
 from collections import namedtuple
 from actions.policies import Prismatic, Revolute
-from gen.generate_policy_data import get_true_ys
+from gen.generate_policy_data import GroundTruthEvaluator
 
 PlotData = namedtuple('PlotData', 'param_name varied range')
 
@@ -22,6 +21,12 @@ def viz_circles(plot_mode, image_data, mech, beta=None, sample_points={}, opt_po
     np_im = np.array(im, dtype=np.uint8).reshape(h, w, 3)
     ax.imshow(np_im)
     policy_types = ['Prismatic', 'Revolute']
+    if plot_mode == util.GROUND_TRUTH_PLOT:
+        # load the mechanism once for all of the ground truth grids
+        evaluator = GroundTruthEvaluator(mech)
+    if plot_mode == util.GP_NN_PLOT:
+        # encode the image once for all of the NN grids
+        image_emb = nn.encode_image(get_image_tensor(image_data))
 
     for policy_type in policy_types:
         if plot_mode == util.GP_PLOT or plot_mode == util.GP_NN_PLOT:
@@ -123,13 +128,10 @@ def viz_circles(plot_mode, image_data, mech, beta=None, sample_points={}, opt_po
                         Y_std = Y_std.squeeze()
                         std_colors = Y_std.reshape(n_angular, n_linear)
                     if plot_mode == util.GP_NN_PLOT:
-                        loader = format_batch(policy_type, X_pred, mech, image_data)
-                        k, x, im, _, _ = next(iter(loader))
-                        pol = torch.Tensor([util.name_lookup[k[0]]])
-                        nn_preds = nn(pol, x.float(), im)[0].detach().numpy()
+                        nn_preds = nn.predict_from_embedding(policy_type, X_pred, image_emb).numpy()
                         Y_pred = np.add(Y_pred, nn_preds.squeeze())
                     if plot_mode == util.GROUND_TRUTH_PLOT:
-                        Y_pred = get_true_ys(X_pred, mech, \
+                        Y_pred = evaluator.evaluate(X_pred, \
                                     PolicyParams(policy_type, None, all_param_data))
                     mean_colors = Y_pred.reshape(n_angular, n_linear)
 
@@ -248,6 +250,8 @@ def viz_circles(plot_mode, image_data, mech, beta=None, sample_points={}, opt_po
                     # file name is the interaction number
                     sample_num = sum([len(sample_points[pt]) for pt in sample_points])
                     fig.savefig(plot_dir+'/%i.png' % sample_num)
+    if plot_mode == util.GROUND_TRUTH_PLOT:
+        evaluator.close()
     util.write_to_file('mean_fig.pickle', [mean_fig, mean_fig_axes, \
                         all_param_data, all_angular_params, all_linear_params])
 
@@ -291,22 +295,6 @@ def add_colorbar(fig, im):
     fig.colorbar(im, cax=cbar_ax)
 
 
-def format_batch(ptype, x_pred, mech, image_data):
-
-    parsed_data = []
-    for ix in range(x_pred.shape[0]):
-        parsed_data.append({
-            'type': ptype,
-            'params': x_pred[ix],
-            'image': image_data,
-            'y': 0.0
-        })
-    dataset = PolicyDataset(parsed_data)
-    train_loader = torch.utils.data.DataLoader(dataset=dataset,
-                                               batch_size=len(dataset))
-    return train_loader
-
-
 # takes in an x and returns the values to be plotted
 def get_plot_point(x, angular_name, linear_name, all_param_data, policy_type):
     if policy_type == 'Prismatic':
@@ -53,20 +53,84 @@ class DistanceRegressor(nn.Module):
         :param theta: The policy parameters.
         :return:
         """
-        if policy_type == 0:
-            policy_type = 'Prismatic'
-        else:
-            policy_type = 'Revolute'
-        pol = self.policy_modules[policy_type].forward(theta)
         im, points = self.image_module(im)
+        return self._predict(policy_type, theta, im), points
+
+    def forward_shared(self, policy_type, theta, im, im_ixs):
+        """
+        Same as forward but each image is only encoded once and its embedding is
+        used for all the rows of theta on that image.
+        :param im: The unique images of the batch.
+        :param im_ixs: LongTensor, the index in im of the image of each row of theta.
+        :return:
+        """
+        im, points = self.image_module(im)
+        im = torch.index_select(im, 0, im_ixs)
+        points = torch.index_select(points, 0, im_ixs)
+        return self._predict(policy_type, theta, im), points
+
+    def encode_image(self, im):
+        """
+        Encode images once so many policies can be scored on them with
+        predict_from_embedding.
+        :param im: Image tensor (3, h, w) or batch of images (n, 3, h, w).
+        :return: The image embeddings (1, 2*hdim) or (n, 2*hdim).
+        """
+        if im.dim() == 3:
+            im = im.unsqueeze(0)
+        with torch.no_grad():
+            emb, _ = self.image_module(im)
+        return emb
+
+    def predict_from_embedding(self, policy_type, theta, emb):
+        """
+        Predict the distance moved by a batch of policies of a single type.
+        :param policy_type: The name of the policy class or its index (see util.name_lookup).
+        :param theta: The policy parameters (N, d) or (d,), a tensor or np.array.
+        :param emb: An embedding from encode_image, (1, 2*hdim) to use the same image
+                    for all policies or (N, 2*hdim).
+        :return: The predicted distances (N, 1).
+        """
+        theta = torch.as_tensor(theta, dtype=emb.dtype, device=emb.device)
+        if theta.dim() == 1:
+            theta = theta.unsqueeze(0)
+        with torch.no_grad():
+            return self._predict(policy_type, theta, emb)
+
+    def grad_from_embedding(self, policy_type, theta, emb):
+        """
+        Same as predict_from_embedding but also returns the gradient of each
+        prediction with respect to its policy parameters.
+        :return: The predicted distances (N, 1) and their gradients (N, d).
+        """
+        theta = torch.as_tensor(theta, dtype=emb.dtype, device=emb.device)
+        if theta.dim() == 1:
+            theta = theta.unsqueeze(0)
+        theta = theta.detach().requires_grad_(True)
+        with torch.enable_grad():
+            pred = self._predict(policy_type, theta, emb.detach())
+            # each prediction only depends on its own row of theta
+            grad, = torch.autograd.grad(pred.sum(), theta)
+        return pred.detach(), grad
+
+    def _predict(self, policy_type, theta, im):
+        """
+        The policy encoder and regression head, im is an image embedding with
+        a row for each row of theta or a single row shared by all of them.
+        """
+        if not isinstance(policy_type, str):
+            policy_type = 'Prismatic' if policy_type == 0 else 'Revolute'
+        pol = self.policy_modules[policy_type].forward(theta)
 
         # x = pol*im
         # x_norm = torch.norm(x, p=2, dim=1, keepdim=True)
         # x = x/x_norm
+        if im.shape[0] != pol.shape[0]:
+            im = im.expand(pol.shape[0], -1)
         x = torch.cat([pol, im], dim=1)
         # x = pol + im
 
         x = F.relu(self.fc1(x))
         x = F.relu(self.fc2(x))
         x = self.fc5(x)
-        return x, points
+        return x
@@ -32,20 +32,27 @@ class ImageEncoder(nn.Module):
         self.scale = nn.Linear(2, 2)
         self.sm = nn.Softmax(dim=1)
         self.temp = nn.Parameter(torch.tensor(1.0))
+        # cached per (h, w, device, dtype). These are plain attributes and not buffers
+        # so they aren't part of the state_dict (and saved models still load)
+        self._grids = {}
+
+    def get_grid(self, h, w, device, dtype):
+        """
+        :return: tensor (h*w, 2), the (x, y) position in [-1, 1] of each pixel of
+                    a flattened h x w feature map
+        """
+        key = (h, w, device, dtype)
+        if key not in self._grids:
+            pos_y, pos_x = torch.meshgrid(
+                torch.linspace(-1., 1., h, dtype=dtype),
+                torch.linspace(-1., 1., w, dtype=dtype))
+            grid = torch.stack([pos_x.reshape(h*w), pos_y.reshape(h*w)], dim=1)
+            self._grids[key] = grid.to(device)
+        return self._grids[key]
 
     def forward(self, img):
-        img = img[:, :, 1:, 1:]
-        bs, c, h, w = img.shape
-        pos_y, pos_x = torch.meshgrid(
-            torch.linspace(-1., 1., h),
-            torch.linspace(-1., 1., w))
-        if next(self.parameters()).is_cuda:
-            pos_y = pos_y.cuda()
-            pos_x = pos_x.cuda()
-
-        pos_x = torch.reshape(pos_x, [h * w])
-        pos_y = torch.reshape(pos_y, [h * w])
-        img = self.pad(img)
+        # the padding copies the cropped view into a new contiguous tensor
+        img = self.pad(img[:, :, 1:, 1:])
         x = F.relu(self.conv1(img))
         x = self.pad(x)
         x = self.conv2(x)
@@ -57,13 +64,7 @@ class ImageEncoder(nn.Module):
         # Get expected feature points.
         pfeatures = features.view([-1, h, w])
 
-        expected_x = torch.sum(pos_x.unsqueeze(0).expand_as(features) * features,
-                               dim=1,
-                               keepdim=True)
-        expected_y = torch.sum(pos_y.unsqueeze(0).expand_as(features) * features,
-                               dim=1,
-                               keepdim=True)
-        expected_xy = torch.cat([expected_x, expected_y], dim=1)
+        expected_xy = torch.matmul(features, self.get_grid(h, w, features.device, features.dtype))
         points = expected_xy.view(bs, c, 2)
 
         # imshow(torchvision.utils.make_grid(img), expected_xy.detach().numpy(), pfeatures.detach().numpy())
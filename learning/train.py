@@ -2,10 +2,10 @@ import argparse
 import numpy as np
 import torch
 from learning.models.nn_disp_pol_vis import DistanceRegressor as NNPolVis
-from learning.dataloaders import setup_data_loaders, parse_pickle_file
+from learning.dataloaders import setup_data_loaders, parse_pickle_file, PolicyDataset
 import learning.viz as viz
 from collections import namedtuple
-from utils import util
+from utils import util, dataset_store
 import os
 import matplotlib.pyplot as plt
 from torch.utils.tensorboard import SummaryWriter
@@ -32,12 +32,41 @@ def view_points(img, points):
     return fig
 
 
-def train_eval(args, hdim, batch_size, pviz, results, fname, writer):
-    # Load data
-    data = parse_pickle_file(results)
-
+def forward_batch(net, batch, use_cuda):
+    """ Call net on a batch of a loader from setup_data_loaders
+    :param batch: (types, params, images, ys) or, for loaders with share_images,
+                    (types, params, unique images, image indices, ys)
+    :return: yhat, y, points and the image of each row (only used for debugging)
+    """
+    if len(batch) == 5:
+        k, x, im, im_ixs, y = batch
+    else:
+        (k, x, im, y), im_ixs = batch, None
+    pol = name_lookup[k[0]]
+    if use_cuda:
+        x = x.cuda()
+        im = im.cuda()
+        y = y.cuda()
+        if im_ixs is not None:
+            im_ixs = im_ixs.cuda()
+    if im_ixs is None:
+        yhat, points = net.forward(pol, x, im)
+        return yhat, y, points, lambda kx: im[kx]
+    # encode each image once and share its embedding between its rows
+    yhat, points = net.forward_shared(pol, x, im, im_ixs)
+    return yhat, y, points, lambda kx: im[im_ixs[kx]]
+
+
+def train_eval(args, hdim, batch_size, pviz, data, fname, writer, n_items=None, seed=None):
+    # data is the output of parse_pickle_file or a PolicyDataset, only the first
+    # n_items are used. seed is used to plan the batches (see CustomSampler)
     train_set, val_set, _ = setup_data_loaders(data=data,
-                                               batch_size=batch_size)
+                                               n_items=n_items,
+                                               batch_size=batch_size,
+                                               use_cuda=args.use_cuda,
+                                               num_workers=args.num_workers,
+                                               seed=seed,
+                                               share_images=args.share_images)
 
     # Setup Model
     policy_types = ['Prismatic', 'Revolute']
@@ -59,14 +88,9 @@ def train_eval(args, hdim, batch_size, pviz, results, fname, writer):
     for ex in range(1, args.n_epochs+1):
         train_losses = []
         net.train()
-        for bx, (k, x, im, y, _) in enumerate(train_set):
-            pol = name_lookup[k[0]]
-            if args.use_cuda:
-                x = x.cuda()
-                im = im.cuda()
-                y = y.cuda()
+        for bx, batch in enumerate(train_set):
             optim.zero_grad()
-            yhat, points = net.forward(pol, x, im)
+            yhat, y, points, row_image = forward_batch(net, batch, args.use_cuda)
 
             loss = loss_fn(yhat, y)
             loss.backward()
@@ -77,7 +101,7 @@ def train_eval(args, hdim, batch_size, pviz, results, fname, writer):
 
             if bx == 0 and args.debug:
                 for kx in range(0, yhat.shape[0]//2):
-                    fig = view_points(im[kx, :, :, :].cpu(),
+                    fig = view_points(row_image(kx).cpu(),
                                       points[kx, :, :].cpu().detach().numpy())
                     writer.add_figure('features_%d' % kx, fig, global_step=ex)
 
@@ -90,14 +114,9 @@ def train_eval(args, hdim, batch_size, pviz, results, fname, writer):
             net.eval()
 
             ys, yhats, types = [], [], []
-            for bx, (k, x, im, y, _) in enumerate(val_set):
-                pol = torch.Tensor([name_lookup[k[0]]])
-                if args.use_cuda:
-                    x = x.cuda()
-                    im = im.cuda()
-                    y = y.cuda()
-
-                yhat, _ = net.forward(pol, x, im)
+            for bx, batch in enumerate(val_set):
+                k = batch[0]
+                yhat, y, _, _ = forward_batch(net, batch, args.use_cuda)
 
                 loss = loss_fn(yhat, y)
                 val_losses.append(loss.item())
@@ -122,6 +141,32 @@ def train_eval(args, hdim, batch_size, pviz, results, fname, writer):
                 if pviz:
                     viz.plot_y_yhat(ys, yhats, types, ex, fname, title='PolVis')
 
+def load_sweep_data(data_fname, Ls, M):
+    """ Parse and tensorize the data of the largest L once. The rows of each BusyBox
+    are contiguous so the data of the first L BusyBoxes is a prefix of it.
+    :param data_fname: str, a pickle file of lists of util.Results or a columnar
+                        dataset directory (see utils.dataset_store)
+    :param Ls: list of ints, numbers of BusyBoxes to train on
+    :param M: int, number of interactions per BusyBox to train on
+    :return: PolicyDataset, dict from each L to the number of items of the first L BusyBoxes
+    """
+    if dataset_store.is_dataset(data_fname):
+        dataset = dataset_store.load_dataset(data_fname)
+        data = dataset.parse(max(Ls), M)
+        bb_sizes = np.minimum(np.diff(dataset.bb_offsets[:max(Ls)+1]), M)
+    else:
+        # only keep the results used by the largest L (a dataset directory avoids
+        # unpickling the whole file)
+        all_results = util.read_results(data_fname, max(Ls), M)
+        results = []
+        for L_results in all_results:
+            results += L_results
+        data = parse_pickle_file(results)
+        bb_sizes = [len(L_results) for L_results in all_results]
+    bb_offsets = np.cumsum(np.concatenate([[0], bb_sizes])).astype(int)
+    n_items = {L: int(bb_offsets[min(L, len(bb_sizes))]) for L in Ls}
+    return PolicyDataset(data), n_items
+
 def get_train_params(args):
     return {'batch_size': args.batch_size,
             'hdim': args.hdim,
@@ -131,7 +176,9 @@ def get_train_params(args):
             'L_min': args.L_min,
             'L_max': args.L_max,
             'L_step': args.L_step,
-            'M': args.M}
+            'M': args.M,
+            'num_workers': args.num_workers,
+            'share_images': args.share_images}
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -150,6 +197,10 @@ if __name__ == '__main__':
     parser.add_argument('--M', type=int, default=100)
     parser.add_argument('--image-encoder', type=str, default='spatial', choices=['spatial', 'cnn'])
     parser.add_argument('--pviz', action='store_true')
+    # number of processes fetching (and prefetching) batches, 0 fetches them in the main process
+    parser.add_argument('--num-workers', type=int, default=0)
+    # group batches by BusyBox and run the image encoder once per unique image
+    parser.add_argument('--share-images', action='store_true')
     args = parser.parse_args()
 
     if args.debug:
@@ -164,13 +215,12 @@ if __name__ == '__main__':
     # make tensorboard writer
     writer = SummaryWriter(runs_dir)
 
-    all_results = util.read_from_file(args.data_fname)
-    for L in range(args.L_min, args.L_max+1, args.L_step):
-        results = []
-        for L_results in all_results[0:L]:
-            results += L_results[0:args.M]
+    Ls = list(range(args.L_min, args.L_max+1, args.L_step))
+    full_set, n_items = load_sweep_data(args.data_fname, Ls, args.M)
+    for L in Ls:
         model_fname = model_dir+'model_'+str(L)+'L_'+str(args.M)+'M'
-        train_eval(args, args.hdim, args.batch_size, args.pviz, results, model_fname, writer)
+        train_eval(args, args.hdim, args.batch_size, args.pviz, full_set, model_fname, writer,
+                   n_items=n_items[L])
 
     writer.close()
 
@@ -0,0 +1,129 @@
+""" Trains a grid of (L, hdim, batch_size, seed) models at the same time, each
+configuration in one of n-procs worker processes. The cores are split evenly
+between the workers so they don't oversubscribe the CPU. The data is loaded once
+and shared with the workers (not copied). Results are written to the same layout
+as learning.train: TensorBoard scalars in save-dir/runs and models in
+save-dir/torch_models (their names are tagged with the hdim, see
+learning.gp.evaluate_models.get_models).
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import random
+import numpy as np
+import torch
+from torch.utils.tensorboard import SummaryWriter
+from learning.train import train_eval, load_sweep_data
+from utils import util
+
+# data of the largest L, shared by all of the worker processes (see _init_worker)
+_worker_data = {}
+
+
+def get_model_fname(model_dir, L, M, hdim, batch_size, seed):
+    return model_dir+'model_%dL_%dM_%dhdim_%dbs_%dseed' % (L, M, hdim, batch_size, seed)
+
+
+def _init_worker(args, full_set, n_items, n_threads):
+    torch.set_num_threads(n_threads)
+    _worker_data['full_set'] = full_set
+    _worker_data['n_items'] = n_items
+
+
+def _train_config(config_args):
+    args, (L, hdim, batch_size, seed) = config_args
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    model_fname = get_model_fname(args.save_dir+'/torch_models/', L, args.M, hdim, batch_size, seed)
+    # each config writes its own event file in the shared runs dir, closing it makes
+    # sure the events are written before the pool shuts the worker down
+    writer = SummaryWriter(args.save_dir+'/runs')
+    train_eval(args, hdim, batch_size, args.pviz, _worker_data['full_set'], model_fname,
+               writer, n_items=_worker_data['n_items'][L], seed=seed)
+    writer.close()
+    return model_fname
+
+
+def train_parallel(args):
+    Ls = list(range(args.L_min, args.L_max+1, args.L_step))
+    configs = list(itertools.product(Ls, args.hdims, args.batch_sizes, args.seeds))
+    n_procs = min(args.n_procs, len(configs))
+    n_threads = max(1, multiprocessing.cpu_count() // n_procs)
+    print('Training %i models in %i processes with %i threads each' % (len(configs), n_procs, n_threads))
+    # the tensors are in shared memory so each worker maps the same copy of the data
+    full_set, n_items = load_sweep_data(args.data_fname, Ls, args.M)
+    full_set.share_memory_()
+
+    # spawn so the workers don't inherit the parent's torch/OpenMP thread state
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes=n_procs, initializer=_init_worker,
+                  initargs=(args, full_set, n_items, n_threads)) as pool:
+        # one config at a time so the longest (largest L) configs don't pile up on one worker
+        for ix, model_fname in enumerate(pool.imap_unordered(_train_config,
+                                        [(args, config) for config in configs], chunksize=1)):
+            print('[%i/%i] finished training %s' % (ix+1, len(configs), model_fname))
+
+
+def get_train_params(args):
+    return {'batch_sizes': args.batch_sizes,
+            'hdims': args.hdims,
+            'seeds': args.seeds,
+            'n_epochs': args.n_epochs,
+            'val_freq': args.val_freq,
+            'data-fname': args.data_fname,
+            'L_min': args.L_min,
+            'L_max': args.L_max,
+            'L_step': args.L_step,
+            'M': args.M,
+            'n_procs': args.n_procs,
+            'share_images': args.share_images}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-sizes', nargs='+', type=int, required=True)
+    parser.add_argument('--hdims', nargs='+', type=int, required=True)
+    parser.add_argument('--seeds', nargs='+', type=int, default=[0])
+    parser.add_argument('--n-epochs', type=int, default=10)
+    parser.add_argument('--val-freq', type=int, default=5)
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--data-fname', type=str, required=True)
+    parser.add_argument('--save-dir', required=True, type=str)
+    # if want to just train one L, make L_min == L_max and L_step == 1
+    parser.add_argument('--L-min', type=int, default=10)
+    parser.add_argument('--L-max', type=int, default=100)
+    parser.add_argument('--L-step', type=int, default=10)
+    parser.add_argument('--M', type=int, default=100)
+    parser.add_argument('--image-encoder', type=str, default='spatial', choices=['spatial', 'cnn'])
+    parser.add_argument('--pviz', action='store_true')
+    # group batches by BusyBox and run the image encoder once per unique image
+    parser.add_argument('--share-images', action='store_true')
+    # number of models trained at the same time
+    parser.add_argument('--n-procs', type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+    # training is CPU only and the pool workers can't start DataLoader workers
+    args.use_cuda = False
+    args.num_workers = 0
+
+    if args.debug:
+        import pdb; pdb.set_trace()
+    # remake dirs (don't want to overwrite data)
+    os.makedirs('./'+args.save_dir+'/')
+    os.makedirs('./'+args.save_dir+'/torch_models/')
+    os.makedirs('./'+args.save_dir+'/runs')
+
+    train_parallel(args)
+
+    # save run params to text file in models dir
+    try:
+        import git
+        repo = git.Repo(search_parent_directories=True)
+        all_params = {'branch': repo.active_branch, 'hash': repo.head.object.hexsha}
+    except:
+        print('install gitpython to save git hash to run params')
+        all_params = {}
+    all_params.update(get_train_params(args))
+    util.write_to_file(args.save_dir+'/run_params.txt', str(all_params)+'\n')
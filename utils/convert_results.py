@@ -0,0 +1,82 @@
+""" Converts pickled datasets of util.Results (eg. from gen.generate_policy_data or
+learning.gp.explore_single_bb) to a columnar dataset directory (see
+utils.dataset_store). The input files are read one at a time (and result streams
+one BusyBox at a time) so many files can be merged into one dataset without
+loading them all into memory.
+"""
+import argparse
+import itertools
+import sys
+from utils import util, dataset_store
+
+
+def _group_by_busybox(results):
+    """ Splits a flat list of util.Results into lists of consecutive results on
+    the same mechanism
+    """
+    bb_results = []
+    for result in results:
+        if len(bb_results) > 0 and result.mechanism_params != bb_results[-1].mechanism_params:
+            yield bb_results
+            bb_results = []
+        bb_results.append(result)
+    if len(bb_results) > 0:
+        yield bb_results
+
+
+def iter_busyboxes(file_name):
+    """ Yields the list of util.Results of each BusyBox in file_name
+    """
+    all_bb_results = util.iter_results(file_name)
+    first = next(all_bb_results, None)
+    if first is None:
+        return
+    all_bb_results = itertools.chain([first], all_bb_results)
+    # some old datasets are flat lists of util.Results
+    if isinstance(first, util.Result):
+        all_bb_results = _group_by_busybox(all_bb_results)
+    for bb_results in all_bb_results:
+        if not isinstance(bb_results, (list, tuple)) or \
+            not all(isinstance(result, util.Result) for result in bb_results):
+            raise Exception(file_name+' is not a dataset of util.Results')
+        if len(bb_results) > 0:
+            yield bb_results
+
+
+def convert(in_file_names, out_dir, batch_size=64):
+    """
+    :param in_file_names: list of str, pickle files to convert, their BusyBoxes are
+                            concatenated in order
+    :param out_dir: str, directory to write the dataset to
+    :param batch_size: int, number of BusyBoxes buffered between writes
+    """
+    writer = dataset_store.DatasetWriter(out_dir, buffer_size=batch_size)
+    for file_ix, file_name in enumerate(in_file_names):
+        n_bbs, first_row = 0, writer.bb_offsets[-1]
+        for bb_results in iter_busyboxes(file_name):
+            writer.write(bb_results)
+            n_bbs += 1
+            sys.stdout.write('\r[file %i/%i] converted %i BusyBoxes (%i results) from %s' % \
+                                (file_ix+1, len(in_file_names), n_bbs,
+                                writer.bb_offsets[-1]-first_row, file_name))
+        print()
+    writer.close()
+    print('wrote dataset with %i BusyBoxes (%i results) to %s' % (len(writer.mechanism_params),
+                                                                writer.bb_offsets[-1], out_dir))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--in-fnames', nargs='+', required=True, type=str,
+                        help='pickle files of util.Results to convert (and merge)')
+    parser.add_argument('--out-dir', required=True, type=str,
+                        help='directory to write the dataset to')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='number of BusyBoxes to buffer between writes')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+
+    if args.debug:
+        import pdb; pdb.set_trace()
+
+    convert(args.in_fnames, args.out_dir, args.batch_size)
@@ -0,0 +1,306 @@
+""" Columnar on-disk format for interaction datasets.
+
+A dataset is a directory with a meta.json file and one raw binary file per
+column. Each row is one interaction (util.Result) and the rows of a BusyBox are
+contiguous. Columns:
+    params      float64 (n_rows, max_dims), varied policy params, NaN padded
+    policy_type uint8 (n_rows,), index into meta['policy_types']
+    net_motion  float64 (n_rows,)
+    cumu_motion float64 (n_rows,)
+    bb_id       int64 (n_rows,), index of the row's BusyBox
+    images      uint8 (n_bbs, height, width, 3), one image per BusyBox
+The BusyBox mechanism params, the row offsets of each BusyBox and the
+param_data of each policy type are stored in meta.json. Only the data used by
+learning and the GP scripts is kept (eg. not the non-varied policy params or the
+handle poses).
+"""
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+from utils import util
+
+META_FNAME = 'meta.json'
+COLUMNS = OrderedDict([('params', np.float64),
+                       ('policy_type', np.uint8),
+                       ('net_motion', np.float64),
+                       ('cumu_motion', np.float64),
+                       ('bb_id', np.int64),
+                       ('images', np.uint8)])
+
+
+def is_dataset(path):
+    """ True if path is a columnar dataset directory (vs. a pickle file)
+    """
+    return path is not None and os.path.isfile(os.path.join(path, META_FNAME))
+
+
+def _to_json(x):
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    if isinstance(x, (tuple, list)):
+        return [_to_json(elem) for elem in x]
+    if isinstance(x, np.bool_):
+        return bool(x)
+    if isinstance(x, np.integer):
+        return int(x)
+    if isinstance(x, np.floating):
+        return float(x)
+    return x
+
+
+def _to_tuples(x):
+    if isinstance(x, list):
+        return tuple(_to_tuples(elem) for elem in x)
+    return x
+
+
+class DatasetWriter(object):
+    def __init__(self, dir_name, buffer_size=64):
+        """ Writes a columnar dataset one BusyBox at a time. The dataset isn't
+        readable until close() writes meta.json.
+        :param dir_name: str, directory to write the dataset to (must not already
+                            contain a dataset)
+        :param buffer_size: int, number of BusyBoxes buffered in memory between
+                            writes to the column files
+        """
+        if is_dataset(dir_name):
+            raise Exception(dir_name+' already contains a dataset')
+        os.makedirs(dir_name, exist_ok=True)
+        self.dir_name = dir_name
+        self.handles = {name: open(os.path.join(dir_name, name+'.bin'), 'wb')
+                            for name in COLUMNS}
+        self.policy_types = []
+        self.param_data = OrderedDict()
+        # rows are padded to the most varied params of any policy type
+        from actions.policies import Policy
+        self.max_dims = max(Policy.get_param_dims(['Prismatic', 'Revolute']))
+        self.mechanism_params = []
+        self.bb_offsets = [0]
+        self.image_shape = None
+        self.git_hash = None
+        self.buffer_size = buffer_size
+        self._buffers = {name: [] for name in COLUMNS}
+
+    def _add_policy_type(self, policy_params):
+        if policy_params.type not in self.param_data:
+            self.policy_types.append(policy_params.type)
+            self.param_data[policy_params.type] = \
+                    [[name, bool(data.varied), _to_json(data.bounds), data.type]
+                        for name, data in policy_params.param_data.items()]
+        return self.policy_types.index(policy_params.type)
+
+    def write(self, bb_results):
+        """ Append the rows of a single BusyBox
+        :param bb_results: list of util.Results all on the same BusyBox, the image
+                            and mechanism of the first one are stored for the BusyBox.
+                            Results without policy_params (eg. from get_bb_dataset)
+                            only add the BusyBox, not a row
+        """
+        assert len(bb_results) > 0, 'BusyBoxes must have at least one result'
+        bb_i = len(self.mechanism_params)
+        w, h, im = bb_results[0].image_data
+        np_im = np.asarray(im, dtype=np.uint8).reshape(h, w, 3)
+        if self.image_shape is None:
+            self.image_shape = np_im.shape
+        assert np_im.shape == self.image_shape, 'all BusyBox images must be the same size'
+        self.mechanism_params.append(_to_json(bb_results[0].mechanism_params))
+        if self.git_hash is None:
+            self.git_hash = bb_results[0].git_hash
+
+        bb_results = [result for result in bb_results if result.policy_params is not None]
+        params, types = [], []
+        for result in bb_results:
+            types.append(self._add_policy_type(result.policy_params))
+            params.append([result.policy_params.params[name]
+                            for name, data in result.policy_params.param_data.items()
+                            if data.varied])
+        padded = np.full((len(bb_results), self.max_dims), np.nan)
+        for i, row in enumerate(params):
+            assert len(row) <= self.max_dims, 'policy has more varied params than the dataset'
+            padded[i, :len(row)] = row
+
+        columns = {'params': padded,
+                   'policy_type': np.array(types, dtype=np.uint8),
+                   'net_motion': [result.net_motion for result in bb_results],
+                   'cumu_motion': [result.cumu_motion for result in bb_results],
+                   'bb_id': np.full(len(bb_results), bb_i),
+                   'images': np_im[np.newaxis]}
+        for name, dtype in COLUMNS.items():
+            self._buffers[name].append(np.asarray(columns[name], dtype=dtype))
+        self.bb_offsets.append(self.bb_offsets[-1]+len(bb_results))
+        if len(self._buffers['images']) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """ Write the buffered BusyBoxes to the column files
+        """
+        for name, dtype in COLUMNS.items():
+            if len(self._buffers[name]) > 0:
+                self.handles[name].write(np.concatenate(self._buffers[name]).tobytes())
+            self._buffers[name] = []
+
+    def close(self):
+        self.flush()
+        for handle in self.handles.values():
+            handle.close()
+        h, w, _ = self.image_shape if self.image_shape is not None else (0, 0, 3)
+        meta = {'n_rows': self.bb_offsets[-1],
+                'n_bbs': len(self.mechanism_params),
+                'max_dims': self.max_dims,
+                'image_height': h,
+                'image_width': w,
+                'policy_types': self.policy_types,
+                'param_data': self.param_data,
+                'mechanism_params': self.mechanism_params,
+                'bb_offsets': self.bb_offsets,
+                'git_hash': self.git_hash}
+        # meta.json is written last (and atomically) so an interrupted write never
+        # looks like a complete dataset
+        file_name = os.path.join(self.dir_name, META_FNAME)
+        with open(file_name+'.tmp', 'w') as handle:
+            json.dump(meta, handle)
+        os.replace(file_name+'.tmp', file_name)
+
+
+def write_dataset(dir_name, results):
+    """
+    :param dir_name: str, directory to write the dataset to
+    :param results: list of lists of util.Results, one list per BusyBox
+    """
+    writer = DatasetWriter(dir_name)
+    for bb_results in results:
+        writer.write(bb_results)
+    writer.close()
+
+
+class ColumnarDataset(object):
+    def __init__(self, dir_name):
+        """ Read-only view of a columnar dataset. Columns are memory mapped so
+        only the rows that are used are read from disk, eg. learning.train only
+        reads the first M interactions of the first L BusyBoxes for each L.
+        :param dir_name: str, dataset directory
+        """
+        with open(os.path.join(dir_name, META_FNAME), 'r') as handle:
+            self.meta = json.load(handle)
+        self.dir_name = dir_name
+        self.policy_types = self.meta['policy_types']
+        self.bb_offsets = np.array(self.meta['bb_offsets'], dtype=np.int64)
+        n, n_bbs = self.meta['n_rows'], self.meta['n_bbs']
+        shapes = {'params': (n, self.meta['max_dims']),
+                  'policy_type': (n,),
+                  'net_motion': (n,),
+                  'cumu_motion': (n,),
+                  'bb_id': (n,),
+                  'images': (n_bbs, self.meta['image_height'], self.meta['image_width'], 3)}
+        for name, dtype in COLUMNS.items():
+            if np.prod(shapes[name]) == 0:
+                column = np.zeros(shapes[name], dtype=dtype)
+            else:
+                column = np.memmap(os.path.join(dir_name, name+'.bin'), dtype=dtype,
+                                    mode='r', shape=shapes[name])
+            setattr(self, name, column)
+        self._image_data = {}
+
+    def __len__(self):
+        return self.meta['n_rows']
+
+    @property
+    def n_bbs(self):
+        return self.meta['n_bbs']
+
+    def get_mechanism_params(self, bb_i):
+        """
+        :return: gen.generator_busybox.MechanismParams of BusyBox bb_i
+        """
+        from gen.generator_busybox import MechanismParams, SliderParams, DoorParams
+        mech_type, params = self.meta['mechanism_params'][bb_i]
+        params_class = {'Slider': SliderParams, 'Door': DoorParams}[mech_type]
+        return MechanismParams(mech_type, params_class(*_to_tuples(params)))
+
+    def get_image_data(self, bb_i):
+        """
+        :return: util.ImageData of BusyBox bb_i, rgbPixels is a uint8 array of
+                    shape (height, width, 3) shared by all rows of the BusyBox
+        """
+        if bb_i not in self._image_data:
+            np_im = np.array(self.images[bb_i])
+            self._image_data[bb_i] = util.ImageData(np_im.shape[1], np_im.shape[0], np_im)
+        return self._image_data[bb_i]
+
+    def get_param_data(self, policy_type):
+        """
+        :return: OrderedDict of actions.policies.ParamData for the policy type
+        """
+        from actions.policies import ParamData
+        return OrderedDict([(name, ParamData(varied, bounds, param_type))
+                    for name, varied, bounds, param_type in self.meta['param_data'][policy_type]])
+
+    def get_rows(self, L=None, M=None):
+        """
+        :param L: int, number of BusyBoxes to use, all if None
+        :param M: int, number of rows of each BusyBox to use, all if None
+        :return: the rows of the first M results of the first L BusyBoxes, a slice
+                    if they are contiguous (so reading them is a single memmap view)
+                    else an np.array of row indices
+        """
+        L = self.n_bbs if L is None else min(L, self.n_bbs)
+        if L == 0:
+            return slice(0, 0)
+        starts, ends = self.bb_offsets[:L], self.bb_offsets[1:L+1]
+        if M is not None:
+            ends = np.minimum(ends, starts+M)
+        if np.array_equal(ends[:-1], starts[1:]):
+            return slice(int(starts[0]), int(ends[-1]))
+        # concatenate the ranges [start, end) of each BusyBox
+        counts = ends-starts
+        first_ixs = np.cumsum(counts)-counts
+        return np.repeat(starts-first_ixs, counts) + np.arange(counts.sum())
+
+    def select(self, L=None, M=None):
+        """ Read the first M results of the first L BusyBoxes. Only those rows are
+        read from disk.
+        :return: dict of np.arrays with keys params, policy_type, net_motion,
+                    cumu_motion and bb_id (see module docstring for shapes)
+        """
+        rows = self.get_rows(L, M)
+        return {name: np.array(getattr(self, name)[rows]) for name in COLUMNS
+                    if name != 'images'}
+
+    def get_dims(self):
+        """
+        :return: list of ints, number of varied params of each of self.policy_types
+        """
+        return [sum(varied for _, varied, _, _ in self.meta['param_data'][policy_type])
+                    for policy_type in self.policy_types]
+
+    def parse(self, L=None, M=None):
+        """ Same output as learning.dataloaders.parse_pickle_file on the first M
+        results of the first L BusyBoxes
+        :return: list of dicts with keys type, params, image, y
+        """
+        columns = self.select(L, M)
+        dims = self.get_dims()
+        parsed_data = []
+        for params, policy_type, y, bb_i in zip(columns['params'], columns['policy_type'],
+                                                columns['net_motion'], columns['bb_id']):
+            parsed_data.append({
+                'type': self.policy_types[policy_type],
+                'params': params[:dims[policy_type]].tolist(),
+                'image': self.get_image_data(int(bb_i)),
+                'y': float(y),
+            })
+        return parsed_data
+
+    def get_bb_results(self, n_bbs=None):
+        """ One util.Result per BusyBox with only the mechanism params and image
+        set, as returned by gen.generate_policy_data.get_bb_dataset
+        :return: list of lists of util.Results
+        """
+        n_bbs = self.n_bbs if n_bbs is None else min(n_bbs, self.n_bbs)
+        return [[util.Result(None, self.get_mechanism_params(bb_i), None, None, None,
+                    None, self.get_image_data(bb_i), None)] for bb_i in range(n_bbs)]
+
+
+def load_dataset(dir_name):
+    return ColumnarDataset(dir_name)
@@ -1,3 +1,5 @@
+import os
+from collections import OrderedDict
 import pybullet as p
 import pybullet_data
 import numpy as np
@@ -6,71 +8,165 @@ import numpy as np
 import matplotlib.pyplot as plt
 from actions.gripper import Gripper
 
-def setup_env(bb, viz, debug, show_im=False):
-    # disconnect if already connected (may want to change viz from False to True)
-    if p.getConnectionInfo()['isConnected']:
-        p.disconnect()
+# physicsClientId of the client setup_env(client=None) last connected, the only
+# client it disconnects (cleared when it is disconnected, see disconnect)
+_setup_env_client = None
 
+def connect(viz):
+    """ Open a new pyBullet physics client without disconnecting any existing ones.
+    :param viz: if True open a GUI client, else a DIRECT client
+    :return: the physicsClientId of the new client
+    """
     if not viz:
         client = p.connect(p.DIRECT)
     else:
         client = p.connect(p.GUI)
-        p.configureDebugVisualizer(p.COV_ENABLE_GUI,0)
-        p.configureDebugVisualizer(p.COV_ENABLE_MOUSE_PICKING, 0)
-
-    p.setAdditionalSearchPath(pybullet_data.getDataPath())
-    p.setRealTimeSimulation(0)
-
-    p.resetDebugVisualizerCamera(
-        cameraDistance=.15,
-        cameraYaw=180,
-        cameraPitch=0,
-        cameraTargetPosition=(0., 0., bb.height/2))
-
-    plane_id = p.loadURDF("plane.urdf")
-    model = p.loadURDF(bb.file_name, [0., -.3, 0.])
-    bb.set_mechanism_ids(model)
+        p.configureDebugVisualizer(p.COV_ENABLE_GUI, 0, physicsClientId=client)
+        p.configureDebugVisualizer(p.COV_ENABLE_MOUSE_PICKING, 0, physicsClientId=client)
+    # pyBullet reuses the ids of disconnected clients, so if the client setup_env
+    # tracks was disconnected elsewhere this new client isn't setup_env's
+    global _setup_env_client
+    if client == _setup_env_client:
+        _setup_env_client = None
+    return client
 
-    #p.setGravity(0, 0, -10)
-    maxForce = 0
-    mode = p.VELOCITY_CONTROL
-    bb.set_joint_control_mode(mode, maxForce)
+def disconnect(client=None):
+    """ Disconnect a pyBullet client, use this instead of p.disconnect for clients
+    used by setup_env so it never disconnects a client it didn't connect.
+    :param client: the physicsClientId to disconnect, if None the client the last
+                    setup_env(client=None) call connected (if it is still connected)
+    """
+    global _setup_env_client
+    if client is None:
+        client = _setup_env_client
+        if client is None:
+            return
+    if client == _setup_env_client:
+        _setup_env_client = None
+    if p.getConnectionInfo(physicsClientId=client)['isConnected']:
+        p.disconnect(physicsClientId=client)
 
-    # enable torque sensor
-    if bb._mechanisms[0].mechanism_type == 'Door':
-        p.enableJointForceTorqueSensor(bb._bb_id, bb._mechanisms[0]._door_base_id, True)
+IMAGE_CACHE_DIR = 'models/image_cache/'
+# most recently used images in this process, keyed by BusyBox.get_hash()
+IMAGE_CACHE_SIZE = 64
+_image_cache = OrderedDict()
 
+def render_image(bb, client=0):
+    """ Render and crop an image of bb, which must be loaded in client.
+    :return: util.ImageData
+    """
     # can change resolution and shadows with this call
     view_matrix = p.computeViewMatrixFromYawPitchRoll(distance=0.4,
                                                       yaw=180,
                                                       pitch=0,
                                                       roll=0,
                                                       upAxisIndex=2,
-                                                      cameraTargetPosition=(0., 0., bb.height / 2))
+                                                      cameraTargetPosition=(0., 0., bb.height / 2),
+                                                      physicsClientId=client)
 
     aspect = 205. / 154.
     nearPlane = 0.01
     farPlane = 100
     fov = 60
-    projection_matrix = p.computeProjectionMatrixFOV(fov, aspect, nearPlane, farPlane)
+    projection_matrix = p.computeProjectionMatrixFOV(fov, aspect, nearPlane, farPlane, physicsClientId=client)
     image_data_pybullet = p.getCameraImage(205, 154, shadow=0, renderer=p.ER_TINY_RENDERER, viewMatrix=view_matrix, lightDiffuseCoeff=0,
-                                           lightSpecularCoeff=0,projectionMatrix=projection_matrix)
-    image_data = util.ImageData(*image_data_pybullet[:3])
+                                           lightSpecularCoeff=0,projectionMatrix=projection_matrix,
+                                           physicsClientId=client)
 
     w, h, im = image_data_pybullet[:3]
     np_im = np.array(im, dtype=np.uint8).reshape(h, w, 4)[:, :, 0:3]
     np_im = np_im[7:125, 44:160, :]
     w, h, im = np_im.shape[1], np_im.shape[0], np_im.flatten().tolist()
-    image_data = util.ImageData(w, h, im)
+    return util.ImageData(w, h, im)
+
+def get_image(bb, client=0):
+    """ Get the image of bb from the in-process cache, else from the on-disk cache in
+    IMAGE_CACHE_DIR, else render it (bb must then be loaded in client) and cache it.
+    Images are keyed by BusyBox.get_hash() so each distinct busybox is rendered once.
+    :return: util.ImageData
+    """
+    key = bb.get_hash()
+    if key in _image_cache:
+        _image_cache.move_to_end(key)
+        return _image_cache[key]
+
+    file_name = IMAGE_CACHE_DIR + key + '.npy'
+    if os.path.isfile(file_name):
+        np_im = np.load(file_name)
+        image_data = util.ImageData(np_im.shape[1], np_im.shape[0], np_im.flatten().tolist())
+    else:
+        image_data = render_image(bb, client)
+        np_im = np.array(image_data.rgbPixels, dtype=np.uint8).reshape(image_data.height, image_data.width, 3)
+        # write to a temporary file first so concurrent processes never read a partial image
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        tmp_file_name = '%s.%i.tmp' % (file_name, os.getpid())
+        with open(tmp_file_name, 'wb') as handle:
+            np.save(handle, np_im)
+        os.replace(tmp_file_name, file_name)
+    _image_cache[key] = image_data
+    if len(_image_cache) > IMAGE_CACHE_SIZE:
+        _image_cache.popitem(last=False)
+    return image_data
+
+def setup_env(bb, viz, debug, show_im=False, client=None, render=True):
+    """ Load bb into a pyBullet simulation.
+    :param client: if None, a new client is connected (and the one the previous
+                    setup_env(client=None) call connected is disconnected, clients
+                    opened elsewhere, eg. with connect(), are left untouched).
+                    Otherwise the already connected client with this
+                    physicsClientId is reset and reused
+    :param render: if False the image is not rendered (or read from the cache) and
+                    None is returned in its place, use when the image is not needed
+    :return: (util.ImageData, actions.gripper.Gripper), the gripper carries the client
+    """
+    global _setup_env_client
+    if client is None:
+        # disconnect our last client if still connected (may want to change viz from
+        # False to True)
+        disconnect()
+        client = connect(viz)
+        _setup_env_client = client
+    else:
+        p.resetSimulation(physicsClientId=client)
+
+    p.setAdditionalSearchPath(pybullet_data.getDataPath(), physicsClientId=client)
+    p.setRealTimeSimulation(0, physicsClientId=client)
+
+    p.resetDebugVisualizerCamera(
+        cameraDistance=.15,
+        cameraYaw=180,
+        cameraPitch=0,
+        cameraTargetPosition=(0., 0., bb.height/2),
+        physicsClientId=client)
+
+    plane_id = p.loadURDF("plane.urdf", physicsClientId=client)
+    model = p.loadURDF(bb.file_name, [0., -.3, 0.], physicsClientId=client)
+    bb.set_mechanism_ids(model, client)
+
+    #p.setGravity(0, 0, -10)
+    maxForce = 0
+    mode = p.VELOCITY_CONTROL
+    bb.set_joint_control_mode(mode, maxForce)
+
+    # enable torque sensor
+    if bb._mechanisms[0].mechanism_type == 'Door':
+        p.enableJointForceTorqueSensor(bb._bb_id, bb._mechanisms[0]._door_base_id, True,
+                                       physicsClientId=client)
+
+    image_data = None
+    if render:
+        image_data = get_image(bb, client)
 
-    # Display the cropped image.
-    if show_im:
-        np_im = np.array(im, dtype=np.uint8).reshape(h, w, 3)
-        plt.imshow(np_im)
-        plt.show()
+        # Display the cropped image.
+        if show_im:
+            np_im = np.array(image_data.rgbPixels, dtype=np.uint8).reshape(image_data.height, image_data.width, 3)
+            plt.imshow(np_im)
+            plt.show()
 
-    p.stepSimulation()
-    gripper = Gripper(bb._mechanisms[0])
+    p.stepSimulation(physicsClientId=client)
+    gripper = Gripper(bb._mechanisms[0], client=client)
+    # every gripper.reset() restores this initial state
+    gripper.save_state()
     return image_data, gripper
 
 def custom_bb_door():
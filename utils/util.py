@@ -5,6 +5,8 @@ import utils.transformations as trans
 import math
 from collections import namedtuple
 import os
+import json
+import hashlib
 import torch
 from learning.models.nn_disp_pol_vis import DistanceRegressor as NNPolVis
 #from actions import policies
@@ -112,6 +114,7 @@ def compare_results(list_a, list_b):
 def viz_train_test_data(train_data, test_data):
     import matplotlib.pyplot as plt
     from gen.generator_busybox import BusyBox
+    from utils import setup_pybullet
 
     n_inter_per_bb = 100
     n_bbs = int(len(train_data)/n_inter_per_bb)
@@ -125,9 +128,7 @@ def viz_train_test_data(train_data, test_data):
         # plot test data angles and positions
         for (i, point) in enumerate(test_data[:10]):
             bb = BusyBox.bb_from_result(point)
-            if p.getConnectionInfo()['isConnected']:
-                p.disconnect()
-            setup_pybullet.setup_env(bb, False, False)
+            setup_pybullet.setup_env(bb, False, False, render=False)
             mech = bb._mechanisms[0]
             true_policy = policies.generate_policy(mech, False)
             pos = (true_policy.rigid_position[0], true_policy.rigid_position[2])
@@ -144,10 +145,8 @@ def viz_train_test_data(train_data, test_data):
     # plot training data angles and positions
     for n in range(1,n_bbs+1):
         point = train_data[(n-1)*n_inter_per_bb]
-        if p.getConnectionInfo()['isConnected']:
-            p.disconnect()
         bb = BusyBox.bb_from_result(point)
-        setup_pybullet.setup_env(bb, False, False)
+        setup_pybullet.setup_env(bb, False, False, render=False)
         mech = bb._mechanisms[0]
         true_policy = policies.generate_policy(mech, False)
         pitches += [true_policy.pitch]
@@ -286,37 +285,196 @@ def write_to_file(file_name, data, verbose=True):
         print('wrote file to '+file_name)
 
 def read_from_file(file_name, verbose=True):
+    """ Reads a pickle file. Files written by a ResultStreamWriter are returned
+    as the list of the committed lists of results ordered by BusyBox index
+    """
     print('reading in '+file_name)
     with open(file_name, 'rb') as handle:
         data = pickle.load(handle)
+        if _is_result_stream_header(data):
+            records = sorted(_iter_result_stream(handle), key=lambda record: record[0])
+            data = [bb_results for bb_i, bb_results, _ in records]
         if verbose:
             print('successfully read in '+file_name)
     return data
 
+def read_results(file_name, n_bbs=None, n_results=None):
+    """ read_from_file for a list of lists of util.Results (one list per BusyBox)
+    that only keeps the first n_results of the first n_bbs BusyBoxes. Result streams
+    are read one BusyBox at a time so the other results are never all in memory.
+    """
+    print('reading in '+file_name)
+    with open(file_name, 'rb') as handle:
+        data = pickle.load(handle)
+        if not _is_result_stream_header(data):
+            return [bb_results[:n_results] for bb_results in data[:n_bbs]]
+        data = {}
+        for bb_i, bb_results, _ in _iter_result_stream(handle):
+            if n_bbs is None or bb_i < n_bbs:
+                data[bb_i] = bb_results[:n_results]
+    return [data[bb_i] for bb_i in sorted(data)]
+
+RESULT_STREAM_HEADER = {'format': 'result_stream', 'version': 1}
+
+def _is_result_stream_header(data):
+    return isinstance(data, dict) and data.get('format') == RESULT_STREAM_HEADER['format']
+
+def _iter_result_stream(handle):
+    """ Yields the (bb_i, bb_results, end offset) records following the header
+    of a result stream. A partially written last record (eg. the process was
+    killed while writing it) is ignored, a damaged record before the end of the
+    file raises an Exception (so the good records after it are never dropped).
+    """
+    while True:
+        start = handle.tell()
+        try:
+            bb_i, bb_results = pickle.load(handle)
+        except (EOFError, pickle.UnpicklingError, ValueError, TypeError, OverflowError):
+            # a truncated record fails after reading the rest of the file
+            if handle.tell() >= os.fstat(handle.fileno()).st_size:
+                return
+            raise Exception('%s has a damaged record at byte %i that is not at the end of the file' \
+                                % (handle.name, start))
+        yield bb_i, bb_results, handle.tell()
+
+def iter_result_stream(file_name):
+    """ Yields the (bb_i, bb_results) records of a result stream one at a time
+    """
+    with open(file_name, 'rb') as handle:
+        if not _is_result_stream_header(pickle.load(handle)):
+            raise Exception(file_name+' was not written by a ResultStreamWriter')
+        for bb_i, bb_results, _ in _iter_result_stream(handle):
+            yield bb_i, bb_results
+
+class ResultStreamWriter(object):
+    def __init__(self, file_name):
+        """ Appends the results of each BusyBox to file_name as soon as they are
+        collected so memory doesn't grow with the dataset and an interrupted run can
+        be resumed. If file_name already exists its records are kept (a partially
+        written last record is dropped) and their BusyBox indices are in
+        self.committed. Read the file with read_from_file or iter_result_stream.
+        :param file_name: str, path of the stream file
+        """
+        dir = os.path.dirname(file_name)
+        if dir != '' and not os.path.isdir(dir):
+            os.makedirs(dir)
+
+        self.file_name = file_name
+        self.committed = set()
+        end = 0
+        if os.path.isfile(file_name) and os.path.getsize(file_name) > 0:
+            with open(file_name, 'rb') as handle:
+                try:
+                    header = pickle.load(handle)
+                except (EOFError, pickle.UnpicklingError):
+                    header = None
+                if header is not None:
+                    if not _is_result_stream_header(header):
+                        raise Exception(file_name+' exists and was not written by a ResultStreamWriter')
+                    end = handle.tell()
+                    for bb_i, _, end in _iter_result_stream(handle):
+                        self.committed.add(bb_i)
+
+        if end == 0:
+            self.handle = open(file_name, 'wb')
+            pickle.dump(RESULT_STREAM_HEADER, self.handle)
+            self._sync()
+        else:
+            self.handle = open(file_name, 'r+b')
+            self.handle.seek(end)
+            self.handle.truncate()
+
+    def write(self, bb_i, bb_results):
+        """ Commits the results of a single BusyBox
+        :param bb_i: int, index of the BusyBox in the dataset
+        :param bb_results: list of util.Results
+        """
+        pickle.dump((bb_i, bb_results), self.handle)
+        self._sync()
+        self.committed.add(bb_i)
+
+    def _sync(self):
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def close(self):
+        self.handle.close()
+
+def iter_results(file_name):
+    """ Yields the list of util.Results of each BusyBox in a file written by
+    write_to_file or a ResultStreamWriter, in BusyBox order. Result streams are
+    read one BusyBox at a time.
+    """
+    with open(file_name, 'rb') as handle:
+        data = pickle.load(handle)
+        if not _is_result_stream_header(data):
+            for bb_results in data:
+                yield bb_results
+            return
+        # records are almost always in order, only the out of order ones are held
+        pending = {}
+        next_i = 0
+        for bb_i, bb_results, _ in _iter_result_stream(handle):
+            pending[bb_i] = bb_results
+            while next_i in pending:
+                yield pending.pop(next_i)
+                next_i += 1
+    for bb_i in sorted(pending):
+        yield pending[bb_i]
+
 def merge_files(in_file_names, out_file_name):
-    results = []
+    """ Concatenates the lists of BusyBox results in in_file_names into a result
+    stream at out_file_name (read it with read_from_file). Only one BusyBox (or a
+    single legacy pickle) is in memory at a time so the merged results aren't
+    returned. out_file_name may be one of in_file_names, it is only replaced once
+    all of the inputs are read.
+    :return: int, number of BusyBoxes in the merged file
+    """
+    tmp_file_name = out_file_name+'.tmp'
+    # don't resume a stale temp file of an interrupted merge
+    if os.path.isfile(tmp_file_name):
+        os.remove(tmp_file_name)
+    writer = ResultStreamWriter(tmp_file_name)
     for file_name in in_file_names:
-        result = read_from_file(file_name)
-        results += result
-    write_to_file(out_file_name, results)
-    return results
+        print('merging '+file_name)
+        for bb_results in iter_results(file_name):
+            writer.write(len(writer.committed), bb_results)
+    writer.close()
+    os.replace(tmp_file_name, out_file_name)
+    print('wrote file to '+out_file_name)
+    return len(writer.committed)
+
+def params_hash(params):
+    """ A hash of nested lists/tuples of numbers, strings and bools that is the
+    same across processes and runs (unlike hash()), eg. for naming cache files.
+    All numbers (including bools and numpy types) are hashed by their float value.
+    """
+    def to_builtin(x):
+        if isinstance(x, np.ndarray):
+            x = x.tolist()
+        if isinstance(x, (tuple, list)):
+            return [to_builtin(elem) for elem in x]
+        if isinstance(x, (bool, int, float, np.number, np.bool_)):
+            return float(x)
+        return x
+    return hashlib.sha1(json.dumps(to_builtin(params)).encode('utf-8')).hexdigest()
 
 ### PyBullet Helper Functions ###
 
 def replay_result(result):
     from gen.generator_busybox import BusyBox
-    from utils.setup_pybullet import setup_env
+    from utils.setup_pybullet import setup_env, disconnect
     from actions.policies import get_policy_from_tuple
 
     bb = BusyBox.bb_from_result(result)
-    image_data, gripper = setup_env(bb, True, True)
+    _, gripper = setup_env(bb, True, True, render=False)
     mech = bb._mechanisms[0]
     policy = get_policy_from_tuple(result.policy_params)
     pose_handle_base_world = mech.get_pose_handle_base_world()
     traj = policy.generate_trajectory(pose_handle_base_world, True)
     cumu_motion, net_motion, pose_handle_world_final = gripper.execute_trajectory(traj, mech, policy.type, True)
     import pdb; pdb.set_trace()
-    p.disconnect()
+    disconnect(gripper.client)
 
 def vis_frame(pos, quat, length=0.2, lifeTime=0.4):
     """ This function visualizes a coordinate frame for the supplied frame where the
@@ -412,6 +570,20 @@ def quat_math(q0, q1, inv0, inv1):
     res = trans.quaternion_multiply(q0,q1)
     return to_pyquat(res)
 
+def quat_multiply_batch(q0, q1):
+    """ Batched product of quaternions, the total rotation from going to q0 then q1
+    (like quat_math(q0,q1,False,False) but without normalizing)
+    :param q0: array of shape (K,4) or (4,), quaternion rotations (x,y,z,w)
+    :param q1: array of shape (K,4) or (4,), quaternion rotations (x,y,z,w)
+    :return: array of shape (K,4), quaternion rotations (x,y,z,w)
+    """
+    x0, y0, z0, w0 = np.moveaxis(np.asarray(q0, dtype=float), -1, 0)
+    x1, y1, z1, w1 = np.moveaxis(np.asarray(q1, dtype=float), -1, 0)
+    return np.stack([w0*x1 + x0*w1 + y0*z1 - z0*y1,
+                     w0*y1 - x0*z1 + y0*w1 + z0*x1,
+                     w0*z1 + x0*y1 - y0*x1 + z0*w1,
+                     w0*w1 - x0*x1 - y0*y1 - z0*z1], axis=-1)
+
 def to_transquat(pybullet_quat):
     """Convert quaternion from (x,y,z,w) returned from pybullet to
     (w,x,y,z) convention used by transformations.py"""